@@ -0,0 +1,585 @@
+# Exported-asset infrastructure shared by HiveswapScript2 and
+# UnityBehaviorExplorer: json loading, the exported file index, the
+# reference graph, prerendered mermaid charts and the transcript search
+# index. Kept free of the dumper's dependencies and import-time output
+
+import glob
+import os
+import sys
+import pickle
+import hashlib
+import mmap
+import array
+import struct
+import sqlite3
+import shutil
+import subprocess
+import tempfile
+import json
+import re
+import collections
+
+try:
+    from tqdm import tqdm
+except ImportError:
+    def tqdm(iterable, *args):
+        yield from iterable
+
+try:
+    import orjson
+
+    def jsonLoads(data):
+        # Takes bytes or str
+        return orjson.loads(data)
+except ImportError:
+    orjson = None
+
+    def jsonLoads(data):
+        return json.loads(data)
+
+def jsonLoad(fp):
+    # Open fp in binary mode so the text is never decoded separately
+    return jsonLoads(fp.read())
+
+FileID = collections.namedtuple("FileID", ["fileName", "pathId"])
+
+class FileIndex():
+    # (archive, path_id) -> ["archive/Type/Name #path_id.ext", ...] for every
+    # exported file, built with one walk of the export tree and cached,
+    # instead of a glob per lookup
+
+    def __init__(self, cache_path, root):
+        self.cache_path = cache_path
+        self.root = root
+        self.index = None
+        # path_id -> paths in any archive, for "*" lookups
+        self.by_path_id = None
+        self.fresh = False
+
+    def setIndex(self, index):
+        self.index = index
+        by_path_id = collections.defaultdict(list)
+        for (archive, path_id), paths in index.items():
+            by_path_id[path_id] += paths
+        self.by_path_id = dict(by_path_id)
+
+    def build(self):
+        print("Indexing exported files...")
+        index = collections.defaultdict(list)
+        for archive in os.scandir(self.root):
+            if not archive.is_dir():
+                continue
+            for type_dir in os.scandir(archive.path):
+                if not type_dir.is_dir():
+                    continue
+                for entry in os.scandir(type_dir.path):
+                    if match := re.match(r".*\#(\d+)\.", entry.name):
+                        index[(archive.name, match.group(1))].append(f"{archive.name}/{type_dir.name}/{entry.name}")
+
+        self.setIndex(dict(index))
+        self.fresh = True
+        # Forked dump workers can rebuild at the same time
+        tmp_path = f"{self.cache_path}.{os.getpid()}.tmp"
+        with open(tmp_path, "wb") as fp:
+            pickle.dump(self.index, fp)
+        os.replace(tmp_path, self.cache_path)
+
+    def load(self):
+        try:
+            with open(self.cache_path, "rb") as fp:
+                self.setIndex(pickle.load(fp))
+            return True
+        except (FileNotFoundError, EOFError, pickle.UnpicklingError):
+            return False
+
+    def lookup(self, archive, path_id, asset_type="*"):
+        if self.index is None and not self.load():
+            self.build()
+
+        path_id = str(path_id)
+        if archive == "*":
+            matches = self.by_path_id.get(path_id, [])
+        else:
+            matches = self.index.get((archive, path_id), [])
+        if asset_type != "*":
+            matches = [p for p in matches if p.split("/")[1] == asset_type]
+
+        if not matches and not self.fresh:
+            # Cached index may predate the export
+            self.build()
+            return self.lookup(archive, path_id, asset_type)
+        return matches
+
+# Calculate reference graph
+
+def ddictlist():
+    # module level function, picklable
+    return collections.defaultdict(list)
+
+# Keys whose subtrees never hold m_FileName pointers, skipped by findRefs
+FINDREFS_SKIP_KEYS = frozenset()
+
+# {parent path: {key: interned child path}}, shared by every object with the same layout
+ref_paths = collections.defaultdict(dict)
+
+def findRefs(x, name="", skip_keys=FINDREFS_SKIP_KEYS):
+    # Yields (FileID, path) for every pointer in x, in depth-first order.
+    # Uses an explicit stack and only ever pushes containers
+    stack = [(x, name)]
+    pop = stack.pop
+    push = stack.append
+    while stack:
+        (x, name) = pop()
+        if type(x) is dict:
+            if 'm_FileName' in x:
+                yield (FileID(x['m_FileName'], str(x['m_PathID'])), name)
+            paths = ref_paths[name]
+            for k, v in reversed(x.items()):
+                t = type(v)
+                if (t is dict or t is list) and k not in skip_keys:
+                    path = paths.get(k)
+                    if path is None:
+                        path = paths[k] = sys.intern(name + "." + k)
+                    push((v, path))
+        else:
+            for v in reversed(x):
+                t = type(v)
+                if t is dict or t is list:
+                    push((v, name))
+
+def findRefsRecursive(x, name=""):
+    # Reference implementation, kept for benchmarkFindRefs
+    if isinstance(x, dict):
+        if 'm_FileName' in x:
+            id_ = FileID(x['m_FileName'], str(x['m_PathID']))
+            yield (id_, name)
+        for k, v in x.items():
+            yield from findRefsRecursive(v, name=name + "." + k)
+    elif isinstance(x, list):
+        for v in x:
+            yield from findRefsRecursive(v, name=name)
+
+class CompactReferenceGraph():
+    # Read-only reference graph with FileIDs and reference paths interned
+    # to ints and the adjacency stored CSR-style in int32 arrays.
+    # The arrays are memory-mapped straight from the cache file, so
+    # loading only costs the string tables.
+    #
+    # File layout: MAGIC, strings length, strings json ({nodes, names}),
+    # then each array as (count, int32 data), 8-byte aligned.
+
+    MAGIC = b"HSREFS01"
+    ARRAYS = ["by_offsets", "by_sources", "by_names", "from_offsets", "from_targets"]
+
+    def __init__(self, nodes, names, arrays, mm=None):
+        self.nodes = nodes
+        self.names = names
+        self.node_ids = {node: i for i, node in enumerate(nodes)}
+        self.mm = mm
+        # target -> namesOf(target); hub targets are looked up once per
+        # referrer, and rebuilding their names each time is quadratic
+        self.names_of = {}
+        (self.by_offsets, self.by_sources, self.by_names, self.from_offsets, self.from_targets) = arrays
+
+    @classmethod
+    def fromDicts(cls, referencesFrom, referencedBy, referencedAs):
+        node_ids = {}
+        name_ids = {}
+
+        def nodeId(node):
+            return node_ids.setdefault(node, len(node_ids))
+
+        for source, targets in referencesFrom.items():
+            nodeId(source)
+            for target in targets:
+                nodeId(target)
+        for target in referencedBy:
+            nodeId(target)
+
+        arrays = {k: array.array('i') for k in cls.ARRAYS}
+        for node in list(node_ids):
+            # Each occurrence of a source in referencedBy[node] is one edge,
+            # named by the matching entry in referencedAs[node][source]
+            arrays["by_offsets"].append(len(arrays["by_sources"]))
+            seen = collections.Counter()
+            for source in referencedBy.get(node, []):
+                name = referencedAs[node][source][seen[source]]
+                seen[source] += 1
+                arrays["by_sources"].append(nodeId(source))
+                arrays["by_names"].append(name_ids.setdefault(name, len(name_ids)))
+
+            arrays["from_offsets"].append(len(arrays["from_targets"]))
+            for target in referencesFrom.get(node, []):
+                arrays["from_targets"].append(nodeId(target))
+
+        arrays["by_offsets"].append(len(arrays["by_sources"]))
+        arrays["from_offsets"].append(len(arrays["from_targets"]))
+
+        return cls(list(node_ids), list(name_ids), [arrays[k] for k in cls.ARRAYS])
+
+    def save(self, path):
+        def pad(fp):
+            fp.write(b"\0" * (-fp.tell() % 8))
+
+        strings = json.dumps({"nodes": self.nodes, "names": self.names}).encode("utf-8")
+        with open(path + ".tmp", "wb") as fp:
+            fp.write(self.MAGIC)
+            fp.write(struct.pack("<Q", len(strings)))
+            fp.write(strings)
+            pad(fp)
+            for k in self.ARRAYS:
+                data = getattr(self, k)
+                fp.write(struct.pack("<Q", len(data)))
+                fp.write(bytes(data))
+                pad(fp)
+        os.replace(path + ".tmp", path)
+
+    @classmethod
+    def load(cls, path):
+        with open(path, "rb") as fp:
+            mm = mmap.mmap(fp.fileno(), 0, access=mmap.ACCESS_READ)
+
+        if mm[:8] != cls.MAGIC:
+            mm.close()
+            raise ValueError(f"{path} is not a compact reference graph")
+
+        (strings_len,) = struct.unpack_from("<Q", mm, 8)
+        offset = 16
+        strings = json.loads(mm[offset:offset + strings_len])
+        offset += strings_len + (-(offset + strings_len) % 8)
+
+        arrays = []
+        for k in cls.ARRAYS:
+            (count,) = struct.unpack_from("<Q", mm, offset)
+            offset += 8
+            with memoryview(mm) as view:
+                arrays.append(view[offset:offset + count * 4].cast('i'))
+            offset += count * 4 + (-(count * 4) % 8)
+
+        nodes = [FileID(*node) for node in strings["nodes"]]
+        return cls(nodes, strings["names"], arrays, mm=mm)
+
+    def close(self):
+        if self.mm is None:
+            return
+        # Views into the mmap have to be released before it can be closed
+        for k in self.ARRAYS:
+            getattr(self, k).release()
+            setattr(self, k, array.array('i'))
+        self.names_of.clear()
+        self.mm.close()
+        self.mm = None
+
+    def _edges(self, offsets, node):
+        i = self.node_ids.get(node)
+        if i is None:
+            return range(0)
+        return range(offsets[i], offsets[i + 1])
+
+    def sourcesOf(self, target):
+        return [self.nodes[self.by_sources[e]] for e in self._edges(self.by_offsets, target)]
+
+    def namesOf(self, target):
+        names = self.names_of.get(target)
+        if names is None:
+            names = self.names_of[target] = collections.defaultdict(list)
+            for e in self._edges(self.by_offsets, target):
+                names[self.nodes[self.by_sources[e]]].append(self.names[self.by_names[e]])
+        return names
+
+    def targetsOf(self, source):
+        return [self.nodes[self.from_targets[e]] for e in self._edges(self.from_offsets, source)]
+
+    def hasSources(self, target):
+        return len(self._edges(self.by_offsets, target)) > 0
+
+    def toDicts(self):
+        referencesFrom = collections.defaultdict(list)
+        referencedBy = collections.defaultdict(list)
+        referencedAs = collections.defaultdict(ddictlist)
+        for node in self.nodes:
+            if targets := self.targetsOf(node):
+                referencesFrom[node] = targets
+            if sources := self.sourcesOf(node):
+                referencedBy[node] = sources
+                referencedAs[node] = self.namesOf(node)
+        return (referencesFrom, referencedBy, referencedAs)
+
+
+class CompactView():
+    # Read-only mapping over a CompactReferenceGraph, shaped like the
+    # defaultdicts ReferenceGraph otherwise exposes
+
+    def __init__(self, getter, contains):
+        self.getter = getter
+        self.contains = contains
+
+    def __getitem__(self, key):
+        return self.getter(key)
+
+    def __contains__(self, key):
+        return self.contains(key)
+
+
+class ReferenceGraph():
+    # Who references what:
+    #   referencesFrom[source] -> [target, ...]
+    #   referencedBy[target] -> [source, ...]
+    #   referencedAs[target][source] -> [".field.path", ...]
+    # Nothing is read until one of those is first used; then the graph is
+    # loaded from cache_path, or built (from records() if given and
+    # non-empty, else from the MonoBehaviour json under root) and cached.
+    # With compact=True the cache is a CompactReferenceGraph file and
+    # lookups are served from it until the graph is modified.
+
+    def __init__(self, cache_path, root, records=None, compact=False):
+        self.cache_path = cache_path
+        self.root = root
+        self.records = records
+        self.compact = compact
+        self.loaded = False
+        self.graph = None
+
+        self._referencesFrom = collections.defaultdict(list)
+        self._referencedBy = collections.defaultdict(list)
+        self._referencedAs = collections.defaultdict(ddictlist)
+
+    @property
+    def referencesFrom(self):
+        self.ensure()
+        if self.graph is not None:
+            return CompactView(self.graph.targetsOf, lambda source: bool(self.graph.targetsOf(source)))
+        return self._referencesFrom
+
+    @property
+    def referencedBy(self):
+        self.ensure()
+        if self.graph is not None:
+            return CompactView(self.graph.sourcesOf, self.graph.hasSources)
+        return self._referencedBy
+
+    @property
+    def referencedAs(self):
+        self.ensure()
+        if self.graph is not None:
+            return CompactView(self.graph.namesOf, self.graph.hasSources)
+        return self._referencedAs
+
+    def ensure(self):
+        if self.loaded or self.load():
+            return
+        self.build()
+        self.save()
+
+    def load(self):
+        if self.loaded:
+            return True
+        try:
+            if self.compact:
+                self.graph = CompactReferenceGraph.load(self.cache_path)
+            else:
+                with open(self.cache_path, "rb") as fp:
+                    (self._referencesFrom, self._referencedBy, self._referencedAs) = pickle.load(fp)
+        except (FileNotFoundError, EOFError, ValueError):
+            return False
+        print("Loaded cached references")
+        self.loaded = True
+        return True
+
+    def save(self):
+        if self.graph is not None:
+            # Unmodified since it was loaded
+            return
+        if self.compact:
+            CompactReferenceGraph.fromDicts(self._referencesFrom, self._referencedBy, self._referencedAs).save(self.cache_path)
+            return
+        with open(self.cache_path, "wb") as fp:
+            tup = (self._referencesFrom, self._referencedBy, self._referencedAs,)
+            pickle.dump(tup, fp)
+
+    def thaw(self):
+        # Switch from the read-only compact graph to mutable dicts
+        if self.graph is not None:
+            (self._referencesFrom, self._referencedBy, self._referencedAs) = self.graph.toDicts()
+            self.graph.close()
+            self.graph = None
+
+    def clear(self):
+        if self.graph is not None:
+            self.graph.close()
+            self.graph = None
+        self._referencesFrom.clear()
+        self._referencedBy.clear()
+        self._referencedAs.clear()
+        self.loaded = True
+
+    def drop(self, source):
+        self.thaw()
+        for target in set(self._referencesFrom.pop(source, [])):
+            self._referencedBy[target] = [s for s in self._referencedBy[target] if s != source]
+            self._referencedAs[target].pop(source, None)
+            if not self._referencedBy[target]:
+                del self._referencedBy[target]
+                del self._referencedAs[target]
+
+    def set(self, source, refs):
+        self.drop(source)
+        for target, refd_as in refs:
+            if target.fileName is not None:
+                self._referencesFrom[source].append(target)
+                self._referencedBy[target].append(source)
+                self._referencedAs[target][source].append(refd_as)
+
+    def build(self):
+        print("Building references...")
+        self.clear()
+
+        count = 0
+        for o in tqdm(self.records() if self.records else []):
+            self.set(FileID(o['_folderName'], o['_pathId']), findRefs(o))
+            count += 1
+        if count:
+            return
+
+        for path in tqdm(sorted(glob.glob(os.path.join(self.root, "*", "MonoBehaviour", "*.json")))):
+            folder_name = os.path.relpath(path, self.root).replace("\\", "/").split("/")[0]
+            (path_id,) = re.match(r".*\#(\d+)\.json", path).groups()
+            with open(path, "rb") as fp:
+                parsed = jsonLoad(fp)
+            self.set(FileID(folder_name, path_id), findRefs(parsed))
+
+class MermaidCache():
+    # Mermaid charts rendered to SVG offline, stored in root by the hash
+    # of their source. add() writes <hash>.mmd the first time a chart is
+    # seen (so forked dump workers can share it), and render() turns every
+    # .mmd without an .svg into one, batched into mermaid-cli runs over a
+    # markdown file, because starting the renderer per chart is slow.
+
+    CONFIG = {
+        "htmlLabels": True,
+        "flowchart": {
+            "useMaxWidth": False,
+        }
+    }
+
+    def __init__(self, root, renderer="mmdc"):
+        self.root = root
+        self.renderer = renderer
+
+    def key(self, text):
+        return hashlib.sha1(text.encode("utf-8")).hexdigest()
+
+    def svgPath(self, key):
+        return os.path.join(self.root, key + ".svg")
+
+    def add(self, text):
+        key = self.key(text)
+        source_path = os.path.join(self.root, key + ".mmd")
+        if not os.path.isfile(source_path):
+            os.makedirs(self.root, exist_ok=True)
+            tmp_path = f"{source_path}.{os.getpid()}.tmp"
+            with open(tmp_path, "w", encoding="utf-8") as fp:
+                fp.write(text)
+            os.replace(tmp_path, source_path)
+        return key
+
+    def pending(self):
+        if not os.path.isdir(self.root):
+            return []
+        return sorted(
+            name[:-4] for name in os.listdir(self.root)
+            if name.endswith(".mmd") and not os.path.isfile(self.svgPath(name[:-4]))
+        )
+
+    def render(self, batch_size=100):
+        pending = self.pending()
+        if not pending:
+            return
+
+        renderer = shutil.which(self.renderer)
+        if renderer is None:
+            print(f"{self.renderer} not found, {len(pending)} mermaid charts left unrendered in {self.root}")
+            return
+
+        print(f"Rendering {len(pending)} mermaid charts")
+        for i in range(0, len(pending), batch_size):
+            batch = pending[i:i + batch_size]
+            with tempfile.TemporaryDirectory() as tmp:
+                config_path = os.path.join(tmp, "config.json")
+                with open(config_path, "w", encoding="utf-8") as fp:
+                    json.dump(self.CONFIG, fp)
+
+                batch_path = os.path.join(tmp, "batch.md")
+                with open(batch_path, "w", encoding="utf-8") as fp:
+                    for key in batch:
+                        with open(os.path.join(self.root, key + ".mmd"), encoding="utf-8") as source:
+                            fp.write(f"```mermaid\n{source.read()}\n```\n\n")
+
+                # Charts come out as out-1.svg, out-2.svg... in batch order
+                subprocess.run([
+                    renderer, "--quiet",
+                    "-i", batch_path, "-o", os.path.join(tmp, "out.md"),
+                    "-e", "svg", "-c", config_path,
+                ], check=True)
+                for n, key in enumerate(batch, 1):
+                    shutil.move(os.path.join(tmp, f"out-{n}.svg"), self.svgPath(key))
+
+# Text rendered for the archive record (folder_name, path_id), found at
+# page#anchor in the transcripts
+SearchEntry = collections.namedtuple("SearchEntry", ["folder_name", "path_id", "kind", "text", "page", "anchor"])
+SearchHit = collections.namedtuple("SearchHit", ["folder_name", "path_id", "kind", "page", "anchor", "snippet"])
+
+class SearchIndex():
+    # SQLite FTS5 index of the text in the transcripts. Each dump stage
+    # replaces only its own entries, so skipped stages keep theirs
+
+    def __init__(self, path):
+        self.path = path
+        # The explorer queries it from Flask's request threads
+        self.db = sqlite3.connect(path, check_same_thread=False)
+        self.db.executescript("""
+            CREATE VIRTUAL TABLE IF NOT EXISTS entries USING fts5(
+                text,
+                kind UNINDEXED,
+                folder_name UNINDEXED,
+                path_id UNINDEXED,
+                page UNINDEXED,
+                anchor UNINDEXED,
+                stage UNINDEXED
+            );
+            CREATE TABLE IF NOT EXISTS stages (
+                name TEXT PRIMARY KEY
+            );
+        """)
+
+    def hasStage(self, name):
+        return self.db.execute("SELECT 1 FROM stages WHERE name = ?", (name,)).fetchone() is not None
+
+    def putStage(self, name, entries):
+        rows = [
+            (e.text, e.kind, e.folder_name, e.path_id, e.page, e.anchor, name)
+            # Some text belongs to embedded objects, with no path_id
+            for e in sorted(entries, key=repr)
+        ]
+        with self.db:
+            self.db.execute("DELETE FROM entries WHERE stage = ?", (name,))
+            self.db.executemany("INSERT INTO entries (text, kind, folder_name, path_id, page, anchor, stage) VALUES (?, ?, ?, ?, ?, ?, ?)", rows)
+            self.db.execute("INSERT OR IGNORE INTO stages VALUES (?)", (name,))
+
+    def search(self, query, kind=None, limit=50):
+        # Best matches first; every word of query has to start a word
+        # in the text. Returns SearchHits with the match marked in <b>
+        terms = ['"' + word.replace('"', '""') + '"*' for word in query.split()]
+        if not terms:
+            return []
+        sql = (
+            "SELECT folder_name, path_id, kind, page, anchor, snippet(entries, 0, '<b>', '</b>', '...', 16)"
+            " FROM entries WHERE entries MATCH ?"
+        )
+        params = [" ".join(terms)]
+        if kind is not None:
+            sql += " AND kind = ?"
+            params.append(kind)
+        sql += " ORDER BY rank LIMIT ?"
+        params.append(limit)
+        return [SearchHit(*row) for row in self.db.execute(sql, params)]
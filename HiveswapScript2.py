@@ -1,14 +1,31 @@
 import glob
 import os
+import io
+import itertools
 import asyncio
 import aiofiles
 import pickle
+import hashlib
+import time
+import argparse
+import ast
+import concurrent.futures
+import multiprocessing
+import sqlite3
+import shutil
 import json
 import pprint
 import re
 import collections
+import random
 from urllib.parse import quote_plus, quote
-from functools import lru_cache
+from functools import lru_cache, wraps
+
+import HiveswapCommon
+from HiveswapCommon import (
+    FileID, FileIndex, MermaidCache, ReferenceGraph, SearchEntry, SearchIndex,
+    findRefs, findRefsRecursive, jsonLoad, jsonLoads, orjson,
+)
 
 # TODO: Group items/abilities by TARGET too, not just ITEM
 # that'll be easier to sort into gameplay order probably
@@ -31,23 +48,57 @@ except ImportError as e:
         async def __aexit__(self, type, value, traceback):
             await asyncio.gather(*self.queue)
 
-try:
-    from tqdm import tqdm
-except ImportError:
-    print("tqdm not installed, using dumb iterator")
-
-    def tqdm(iterable, *args):
-        yield from iterable
+if orjson is None:
+    print("orjson not installed, using json")
 
 game_root = "Act2-AssetStudio/ExportDev2"
 
 CACHED = True
+# If not CACHED, only re-parse exported files that changed since the last run
+INCREMENTAL = True
+archive_store_path = "archives.sqlite"
+# Keys indexed by presence, for records that are found by a field
+# rather than by _type
+ARCHIVE_MARKERS = ("ItemID", "AbilityID", "PresentOutcomes")
+
+# "async" overlaps file reads on one core,
+# "process" spreads json parsing across a process pool
+LOADER = "async"
+LOADER_WORKERS = os.cpu_count()
+LOADER_CHUNK_SIZE = 256
+# Forked worker processes for the independent dump stages in main()
+DUMP_WORKERS = os.cpu_count()
+# Re-run dump stages even if their inputs are unchanged
+DUMP_FORCE = False
+# "indent" (json.dump indent=4), "compact" or "lines" (JSON Lines, .jsonl)
+JSON_FORMAT = "indent"
+# Reuse the rendered transcript of shared sub-objects (see cachedTranscript)
+RENDER_CACHE = True
+# Render mermaid charts to SVG files in MERMAID_DIR with a local
+# mermaid-cli (MERMAID_RENDERER) instead of in the browser
+MERMAID_PRERENDER = False
+MERMAID_DIR = "mermaid"
+MERMAID_RENDERER = "mmdc"
+# Write buffer for transcript .html files
+TRANSCRIPT_BUFFER_SIZE = 1 << 20
+# Split each transcript into a file per scene ("scene") or per N items,
+# with the usual file name as an index page
+TRANSCRIPT_SHARDS = None
+# SQLite full-text index of the transcript text, written by runDumps,
+# or None for no index
+SEARCH_INDEX = "search.sqlite"
 
 archives = {}
 archives_fallback = {}
 
 visited = []
 outcomes_seen = set()
+# StageTrace of the dump stage being run, if any
+stage_trace = None
+# SearchEntry records of the text rendered so far, and the transcript
+# page and anchor of the item being written
+search_entries = set()
+search_location = None
 
 # Utilities and loading
 
@@ -62,6 +113,8 @@ def getReference(obj):
 
         if obj['m_PathID'] == 0 and obj['m_FileID'] == 0:
             return None
+        if stage_trace is not None:
+            stage_trace.records.add((file_name, path_id))
         # if obj in visited:
         #     obj['_ERROR'] = "CIRC"
         #     return obj
@@ -105,45 +158,424 @@ def getReference(obj):
 #         yaml.dump(dumped_objs, fp)
 
 
-def iterArchiveFiles():
+ManifestEntry = collections.namedtuple("ManifestEntry", ["path", "folder_name", "path_id", "size", "mtime", "hash"])
+
+class ArchiveFolder():
+    # dict-like view of one archive folder in an ArchiveStore,
+    # so archives[file_name][path_id] keeps working
+
+    def __init__(self, store, folder_name):
+        self.store = store
+        self.folder_name = folder_name
+
+    def __getitem__(self, path_id):
+        return self.store.get(self.folder_name, path_id)
+
+
+class ArchiveStore():
+    # On-disk asset store, indexed by (folder_name, path_id), by _type and
+    # by which ARCHIVE_MARKERS keys a record has.
+    # Records are unpickled on first access and kept, so repeated lookups
+    # return the same dict (getReference callers rely on that)
+
+    def __init__(self, path):
+        self.path = path
+        self.records = {}
+        self._db = None
+        self.pid = None
+        has_markers = self.db.execute(
+            "SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'markers'"
+        ).fetchone()
+        stage_columns = [row[1] for row in self.db.execute("PRAGMA table_info(stages)")]
+        if stage_columns and "examples" not in stage_columns:
+            # Saved before stages kept their EXAMPLES; every stage reruns once
+            self.db.execute("DROP TABLE stages")
+        self.db.executescript("""
+            CREATE TABLE IF NOT EXISTS assets (
+                folder_name TEXT NOT NULL,
+                path_id TEXT NOT NULL,
+                type TEXT,
+                data BLOB NOT NULL,
+                PRIMARY KEY (folder_name, path_id)
+            );
+            CREATE INDEX IF NOT EXISTS assets_type ON assets (type);
+            CREATE TABLE IF NOT EXISTS manifest (
+                path TEXT PRIMARY KEY,
+                folder_name TEXT NOT NULL,
+                path_id TEXT NOT NULL,
+                size INTEGER,
+                mtime INTEGER,
+                hash TEXT
+            );
+            CREATE TABLE IF NOT EXISTS markers (
+                marker TEXT NOT NULL,
+                folder_name TEXT NOT NULL,
+                path_id TEXT NOT NULL,
+                PRIMARY KEY (marker, folder_name, path_id)
+            );
+            CREATE TABLE IF NOT EXISTS stages (
+                name TEXT PRIMARY KEY,
+                fingerprint TEXT NOT NULL,
+                trace BLOB NOT NULL,
+                seen BLOB NOT NULL,
+                examples BLOB NOT NULL
+            );
+        """)
+        if not has_markers and len(self):
+            # Store predates the marker index
+            self.reindexMarkers()
+
+    @property
+    def db(self):
+        # sqlite connections can't be shared with a forked child,
+        # so each process opens its own
+        if self.pid != os.getpid():
+            self._db = sqlite3.connect(self.path)
+            self.pid = os.getpid()
+        return self._db
+
+    def __len__(self):
+        return self.db.execute("SELECT COUNT(*) FROM assets").fetchone()[0]
+
+    def __getitem__(self, folder_name):
+        return ArchiveFolder(self, folder_name)
+
+    def _decode(self, folder_name, path_id, data):
+        key = (folder_name, path_id)
+        if key not in self.records:
+            self.records[key] = pickle.loads(data)
+        return self.records[key]
+
+    def get(self, folder_name, path_id):
+        key = (folder_name, str(path_id))
+        if key in self.records:
+            return self.records[key]
+
+        row = self.db.execute(
+            "SELECT data FROM assets WHERE folder_name = ? AND path_id = ?", key
+        ).fetchone()
+        if row is None:
+            raise KeyError(key)
+        return self._decode(*key, row[0])
+
+    def _select(self, columns, utype=None, folder_name=None, marker=None):
+        query = f"SELECT {columns} FROM assets"
+        clauses, params = [], []
+        if utype is not None:
+            clauses.append("type = ?")
+            params.append(utype)
+        if marker is not None:
+            clauses.append(
+                "EXISTS (SELECT 1 FROM markers WHERE marker = ?"
+                " AND markers.folder_name = assets.folder_name AND markers.path_id = assets.path_id)"
+            )
+            params.append(marker)
+        if folder_name is not None:
+            clauses.append("folder_name = ?")
+            params.append(folder_name)
+        if clauses:
+            query += " WHERE " + " AND ".join(clauses)
+        query += " ORDER BY rowid"
+        return self.db.execute(query, params)
+
+    def iterRecords(self, utype=None, folder_name=None, marker=None):
+        for (row_folder, row_path_id, data) in self._select("folder_name, path_id, data", utype, folder_name, marker):
+            yield self._decode(row_folder, row_path_id, data)
+
+    def keys(self, utype=None, marker=None):
+        # (folder_name, path_id) of matching records, without decoding them
+        return self._select("folder_name, path_id", utype, marker=marker).fetchall()
+
+    def recordHashes(self):
+        # (folder_name, path_id) -> hash of the source file, or of the
+        # pickled record if it has no manifest entry
+        hashes = {}
+        rows = self.db.execute("""
+            SELECT assets.folder_name, assets.path_id, manifest.hash,
+                CASE WHEN manifest.hash IS NULL THEN assets.data END
+            FROM assets LEFT JOIN manifest
+                ON manifest.folder_name = assets.folder_name AND manifest.path_id = assets.path_id
+        """)
+        for (folder_name, path_id, file_hash, data) in rows:
+            hashes[(folder_name, path_id)] = file_hash or hashlib.sha1(data).hexdigest()
+        return hashes
+
+    def putMany(self, objs):
+        rows = []
+        marker_rows = []
+        for o in objs:
+            key = (o['_folderName'], o['_pathId'])
+            self.records[key] = o
+            rows.append((*key, o.get('_type'), pickle.dumps(o, protocol=pickle.HIGHEST_PROTOCOL)))
+            marker_rows += [(m, *key) for m in ARCHIVE_MARKERS if m in o]
+
+        with self.db:
+            self.db.executemany("DELETE FROM markers WHERE folder_name = ? AND path_id = ?", [r[:2] for r in rows])
+            self.db.executemany("INSERT OR REPLACE INTO assets VALUES (?, ?, ?, ?)", rows)
+            self.db.executemany("INSERT INTO markers VALUES (?, ?, ?)", marker_rows)
+
+    def reindexMarkers(self):
+        marker_rows = [
+            (m, o['_folderName'], o['_pathId'])
+            for o in self.iterRecords()
+            for m in ARCHIVE_MARKERS if m in o
+        ]
+        with self.db:
+            self.db.execute("DELETE FROM markers")
+            self.db.executemany("INSERT INTO markers VALUES (?, ?, ?)", marker_rows)
+
+    def delete(self, entries):
+        keys = [(e.folder_name, e.path_id) for e in entries]
+        for key in keys:
+            self.records.pop(key, None)
+
+        with self.db:
+            self.db.executemany("DELETE FROM assets WHERE folder_name = ? AND path_id = ?", keys)
+            self.db.executemany("DELETE FROM markers WHERE folder_name = ? AND path_id = ?", keys)
+            self.db.executemany("DELETE FROM manifest WHERE path = ?", [(e.path,) for e in entries])
+
+    def manifest(self):
+        return {
+            row[0]: ManifestEntry(*row)
+            for row in self.db.execute("SELECT path, folder_name, path_id, size, mtime, hash FROM manifest")
+        }
+
+    def putManifest(self, rows):
+        with self.db:
+            self.db.executemany("INSERT OR REPLACE INTO manifest VALUES (?, ?, ?, ?, ?, ?)", rows)
+
+    def stage(self, name):
+        # (fingerprint, trace, seen, examples) saved by the last run of a dump stage
+        row = self.db.execute("SELECT fingerprint, trace, seen, examples FROM stages WHERE name = ?", (name,)).fetchone()
+        if row is None:
+            return None
+        return (row[0], StageTrace(*pickle.loads(row[1])), pickle.loads(row[2]), pickle.loads(row[3]))
+
+    def putStage(self, name, fingerprint, trace, seen, examples):
+        with self.db:
+            self.db.execute("INSERT OR REPLACE INTO stages VALUES (?, ?, ?, ?, ?)", (
+                name, fingerprint,
+                pickle.dumps(tuple(trace), protocol=pickle.HIGHEST_PROTOCOL),
+                pickle.dumps(seen, protocol=pickle.HIGHEST_PROTOCOL),
+                pickle.dumps(examples, protocol=pickle.HIGHEST_PROTOCOL),
+            ))
+
+    def clear(self):
+        self.records.clear()
+        with self.db:
+            self.db.execute("DELETE FROM assets")
+            self.db.execute("DELETE FROM markers")
+            self.db.execute("DELETE FROM manifest")
+
+
+file_index = FileIndex("scriptfiles.pickle", game_root)
+
+def lookupFile(archive, path_id, asset_type="*"):
+    # file_index.lookup, noted in the stage trace: a stage's output
+    # depends on the file names its references resolve to
+    if stage_trace is not None:
+        stage_trace.files.add((archive, str(path_id), asset_type))
+    return file_index.lookup(archive, path_id, asset_type)
+
+
+def iterArchiveFiles(utype=None, marker=None):
+    # marker must be one of ARCHIVE_MARKERS
+    if isinstance(archives, ArchiveStore):
+        yield from archives.iterRecords(utype=utype, marker=marker)
+        return
+
     for container, paths in archives.items():
         for p in paths:
             o = paths[p]
+            if utype is not None and o.get("_type") != utype:
+                continue
+            if marker is not None and marker not in o:
+                continue
             yield o
 
 
-async def loadJsonAsset(obj, folder_name, path_id, utype):
-    async with aiofiles.open(obj, "r", encoding="utf-8") as fp:
-        o = json.loads(await fp.read())
-        o['_folderName'] = folder_name
-        o['_pathId'] = path_id
-        o['_type'] = utype
-        archives[folder_name][path_id] = o
+def iterAssetPaths():
+    # (path, folder_name, path_id, utype) for every exported json asset
+    for folder in glob.glob(os.path.join(game_root, "*") + "/"):
+        folder_name = os.path.split(os.path.split(folder)[0])[1]
+
+        for path in glob.glob(os.path.join(folder, "**", "*.json")):
+            (utype, path_id,) = re.match(r".*[\\/](.*) \#(\d+)\.json", path).groups()
+            yield (path, folder_name, path_id, utype)
+
+def hashFile(path):
+    with open(path, "rb") as fp:
+        return hashlib.sha1(fp.read()).hexdigest()
+
+def parseJsonAsset(data, folder_name, path_id, utype):
+    o = jsonLoads(data)
+    o['_folderName'] = folder_name
+    o['_pathId'] = path_id
+    o['_type'] = utype
+    return o
+
+def manifestRow(path, folder_name, path_id, data):
+    stat = os.stat(path)
+    return (path, folder_name, path_id, stat.st_size, stat.st_mtime_ns, hashlib.sha1(data).hexdigest())
+
+async def loadJsonAsset(obj, folder_name, path_id, utype, manifest=None):
+    async with aiofiles.open(obj, "rb") as fp:
+        data = await fp.read()
+        o = parseJsonAsset(data, folder_name, path_id, utype)
+        archives.setdefault(folder_name, {})[path_id] = o
+        if references.loaded:
+            references.set(FileID(folder_name, path_id), findRefs(o))
+
+    if manifest is not None:
+        manifest.append(manifestRow(obj, folder_name, path_id, data))
+
+def parseJsonChunk(jobs, with_manifest=True, with_refs=True):
+    # Worker process side of the "process" loader.
+    # Returns a partial archives dict, its manifest rows and its references;
+    # hashing and reference extraction only run if asked for
+    partial = {}
+    manifest = []
+    refs = []
+    for (path, folder_name, path_id, utype) in jobs:
+        with open(path, "rb") as fp:
+            data = fp.read()
+        o = parseJsonAsset(data, folder_name, path_id, utype)
+        partial.setdefault(folder_name, {})[path_id] = o
+        if with_manifest:
+            manifest.append(manifestRow(path, folder_name, path_id, data))
+        if with_refs:
+            refs.append((FileID(folder_name, path_id), list(findRefs(o))))
+    return (partial, manifest, refs)
+
+async def loadJsonAssetsParallel(jobs, manifest=None, workers=None):
+    jobs = list(jobs)
+    chunks = [jobs[i:i + LOADER_CHUNK_SIZE] for i in range(0, len(jobs), LOADER_CHUNK_SIZE)]
+
+    loop = asyncio.get_running_loop()
+    with concurrent.futures.ProcessPoolExecutor(workers or LOADER_WORKERS) as pool:
+        results = await asyncio.gather(*[
+            loop.run_in_executor(pool, parseJsonChunk, chunk, manifest is not None, references.loaded)
+            for chunk in chunks
+        ])
+
+    for (partial, partial_manifest, partial_refs) in results:
+        for folder_name, objs in partial.items():
+            archives.setdefault(folder_name, {}).update(objs)
+        if manifest is not None:
+            manifest += partial_manifest
+        if references.loaded:
+            for (source, refs) in partial_refs:
+                references.set(source, refs)
+
+async def loadJsonAssets(jobs, manifest=None, loader=None):
+    if (loader or LOADER) == "process":
+        return await loadJsonAssetsParallel(jobs, manifest)
+
+    async with AIOSpool(20) as spool:
+        for (path, folder_name, path_id, utype) in jobs:
+            spool.enqueue(loadJsonAsset(path, folder_name, path_id, utype, manifest))
+
+async def benchmarkLoaders():
+    # Both loaders do the same work: parsing only, then parsing plus the
+    # manifest hashes and reference extraction of a rebuild
+    global archives, references
+    jobs = list(iterAssetPaths())
+    print(f"Parsing {len(jobs)} assets")
+
+    saved_references = references
+    try:
+        for rebuild in [False, True]:
+            for loader in ["async", "process"]:
+                archives = {}
+                manifest = [] if rebuild else None
+                # Scratch graph, never saved; clear() marks it loaded so
+                # the loaders extract references into it
+                references = ReferenceGraph(None, game_root)
+                if rebuild:
+                    references.clear()
+                start = time.perf_counter()
+                await loadJsonAssets(jobs, manifest, loader=loader)
+                elapsed = time.perf_counter() - start
+                count = sum(len(v) for v in archives.values())
+                label = f"{loader} (rebuild)" if rebuild else loader
+                print(f"{label:>18}: {elapsed:.2f}s ({count} assets, {count / elapsed:.0f}/s)")
+    finally:
+        references = saved_references
+
+async def refreshArchives(store):
+    # Re-parse only the files that were added, changed or removed
+    # since the manifest was written
+    global archives
+
+    known = store.manifest()
+    changed_jobs = []
+    touched_rows = []
+
+    for job in iterAssetPaths():
+        path = job[0]
+        stat = os.stat(path)
+        entry = known.pop(path, None)
+
+        if entry and (entry.size, entry.mtime) == (stat.st_size, stat.st_mtime_ns):
+            continue
+        if entry and entry.hash == hashFile(path):
+            # Touched but not changed
+            touched_rows.append((*job[:3], stat.st_size, stat.st_mtime_ns, entry.hash))
+            continue
+        changed_jobs.append(job)
+
+    removed = list(known.values())
+    print(f"Refreshing archives: {len(changed_jobs)} changed, {len(removed)} removed")
+
+    # Patch the cached reference graph if there is one,
+    # otherwise it is built from the store on first use
+    references.load()
+    if references.loaded:
+        # Dropped before loading, so a file renamed with the same
+        # (folder_name, path_id) keeps the edges of its new path
+        for entry in removed:
+            references.drop(FileID(entry.folder_name, entry.path_id))
+
+    archives = {}
+    manifest = []
+    await loadJsonAssets(changed_jobs, manifest)
+
+    store.delete(removed)
+    if references.loaded:
+        references.save()
+    store.putMany(iterArchiveFiles())
+    store.putManifest(manifest + touched_rows)
+    archives = store
 
 async def loadArchives():
+    # On a rebuild, references are extracted from the same parsed objects
+    # as the archives, so each file is only read and parsed once
     global archives
-    archive_cache_path = "archives.pickle"
     global CACHED
 
     if CACHED:
-        try:
-            with open(archive_cache_path, "rb") as fp:
-                archives = pickle.load(fp)
-        except:
+        if os.path.isfile(archive_store_path):
+            archives = ArchiveStore(archive_store_path)
+        if not isinstance(archives, ArchiveStore) or not len(archives):
             print("Cache load failed! Rebuilding")
             CACHED = False
             return await loadArchives()
+    elif INCREMENTAL and os.path.isfile(archive_store_path):
+        await refreshArchives(ArchiveStore(archive_store_path))
+        file_index.build()
     else:
-        async with AIOSpool(20) as spool:
-            for folder in glob.glob(os.path.join(game_root, "*") + "/"):
-                folder_name = os.path.split(os.path.split(folder)[0])[1]
-                
-                archives[folder_name] = {}
-                for obj in glob.glob(os.path.join(folder, "**", "*.json")):
-                    (utype, path_id,) = re.match(r".*\\(.*) \#(\d+)\.json", obj).groups()
-                    spool.enqueue(loadJsonAsset(obj, folder_name, path_id, utype))
-        with open(archive_cache_path, "wb") as fp:
-            pickle.dump(archives, fp)
+        archives = {}
+        manifest = []
+        references.clear()
+        await loadJsonAssets(iterAssetPaths(), manifest)
+
+        store = ArchiveStore(archive_store_path)
+        store.clear()
+        store.putMany(iterArchiveFiles())
+        store.putManifest(manifest)
+        archives = store
+        references.save()
+        file_index.build()
 
 def block(gen, kind="block"):
     yield f"<div class='{kind}'>"
@@ -151,6 +583,14 @@ def block(gen, kind="block"):
         yield f"    {i}"
     yield "</div>"
 
+def peek(gen):
+    # None if gen is empty, otherwise an iterator over all of it.
+    # For bodies that are only shown if they have any lines
+    it = iter(gen)
+    for first in it:
+        return itertools.chain([first], it)
+    return None
+
 # HS Classes
 
 EXAMPLES = {}
@@ -219,8 +659,140 @@ SceneNameInBuildSettings = {
     "level36": "010 Final Scene",
 }
 
-class HSMonoBehaviour():
+# (type, folder_name, path_id) -> wrapper, so an asset referenced from many
+# places is only wrapped once per run
+typed_instances = {}
+# HSOutcomeCanvas key -> CompiledCanvas, which holds its node wrappers
+compiled_canvases = {}
+
+def typedInstance(t, ref):
+    # t(ref), memoized for archive records
+    if not (isinstance(ref, dict) and '_folderName' in ref and '_pathId' in ref):
+        return t(ref)
+
+    key = (t, ref['_folderName'], ref['_pathId'])
+    try:
+        return typed_instances[key]
+    except KeyError:
+        instance = typed_instances[key] = t(ref)
+        return instance
+
+def clearTypedInstances():
+    typed_instances.clear()
+    compiled_canvases.clear()
+
+# Finished toTranscriptBody output of an archive record, with the
+# outcomes_seen keys and search text rendering it marked, so all of
+# them can be replayed
+RenderedFragment = collections.namedtuple("RenderedFragment", ["lines", "seen", "texts"])
+
+# (class, folder_name, path_id, args) -> RenderedFragment
+render_cache = {}
+# Fragments being rendered, innermost last
+render_effects = []
+
+def clearRenderCache():
+    render_cache.clear()
+
+def markOutcomesSeen(keys):
+    outcomes_seen.update(keys)
+    for fragment in render_effects:
+        fragment.seen.update(keys)
+
+def indexText(hs, kind, text, anchor=None):
+    # Add text rendered for hs to the search index, at anchor or else at
+    # the transcript item being written
+    if not (SEARCH_INDEX and text):
+        return
+    # Unity rich text tags
+    text = re.sub(r"<[^>]*>", "", text)
+    addSearchEntry(hs.obj.get('_folderName'), hs.obj.get('_pathId'), kind, text, anchor)
+
+def addSearchEntry(folder_name, path_id, kind, text, anchor):
+    entry = (folder_name, path_id, kind, text, anchor)
+    for fragment in render_effects:
+        fragment.texts.append(entry)
+    if search_location is not None:
+        search_entries.add(SearchEntry(*entry[:4], search_location.page, anchor or search_location.anchor))
+
+def cachedTranscript(render):
+    # Decorator for toTranscriptBody: render each archive record once per
+    # set of arguments (e.g. parent_name) and replay the lines after that
+    @wraps(render)
+    def toTranscriptBody(self, *args, **kwargs):
+        obj = self.obj
+        if not (RENDER_CACHE and '_folderName' in obj and '_pathId' in obj):
+            yield from render(self, *args, **kwargs)
+            return
+
+        key = (self.__class__, obj['_folderName'], obj['_pathId'], args, tuple(sorted(kwargs.items())))
+        fragment = render_cache.get(key)
+        if fragment is None:
+            fragment = RenderedFragment([], set(), [])
+            render_effects.append(fragment)
+            try:
+                fragment.lines.extend(render(self, *args, **kwargs))
+            finally:
+                render_effects.pop()
+            render_cache[key] = fragment
+        else:
+            markOutcomesSeen(fragment.seen)
+            for entry in fragment.texts:
+                addSearchEntry(*entry)
+
+        yield from fragment.lines
+
+    return toTranscriptBody
+
+def resolveTyped(t, value):
+    # Wrap a typed field value (a reference or a list of references) in t
+    if isinstance(value, list):
+        return [
+            typedInstance(t, getReference(o)) if o else o
+            for o in value
+        ]
+
+    ref = getReference(value)
+    if ref is None:
+        # References null
+        return None
+    return typedInstance(t, ref)
+
+# Compiled keys_simple / keys_typed of an HSMonoBehaviour subclass
+HSSchema = collections.namedtuple("HSSchema", ["simple", "typed", "known"])
+
+# Typed field not resolved yet, in LAZY mode
+HSPending = collections.namedtuple("HSPending", ["t", "value"])
+
+class HSSlots(type):
+    # Subclasses get an empty __slots__ unless they declare one, so
+    # instances only ever carry the base class slots
+    def __new__(mcls, name, bases, namespace, **kwargs):
+        namespace.setdefault("__slots__", ())
+        return super().__new__(mcls, name, bases, namespace, **kwargs)
+
+class HSMonoBehaviour(metaclass=HSSlots):
+    # obj is the archive record, dict only holds typed fields (and
+    # fields set after construction); simple fields are read from obj
+    __slots__ = ("obj", "dict")
+
     DEBUG = False
+    # Resolve typed fields on first get() instead of in __init__
+    LAZY = False
+    schema = None
+
+    def __init_subclass__(cls, **kwargs):
+        super().__init_subclass__(**kwargs)
+        # keys_typed names classes defined further down the module,
+        # so the schema is compiled on first instantiation instead
+        cls.schema = None
+
+    @classmethod
+    def compileSchema(cls, instance):
+        typed = tuple(instance.keys_typed.items())
+        simple = tuple(instance.keys_simple)
+        cls.schema = HSSchema(simple, typed, frozenset(k for k, t in typed).union(simple))
+        return cls.schema
 
     @property
     def keys_simple(self):
@@ -238,8 +810,25 @@ class HSMonoBehaviour():
         o.update(keys)
         return o
 
-    def get(self, *args, **kwargs):
-        return self.dict.get(*args, **kwargs)
+    def get(self, key, default=None):
+        try:
+            v = self.dict[key]
+        except KeyError:
+            if key in self.schema.known:
+                return getReference(self.obj[key])
+            return default
+        if type(v) is HSPending:
+            v = self.dict[key] = resolveTyped(*v)
+        return v
+
+    def unused(self):
+        # Raw fields not covered by the schema, computed on demand
+        all_keys = set(self.obj.keys())
+        for k, t in self.schema.typed:
+            all_keys.discard(k)
+        for k in self.schema.simple:
+            all_keys.discard(k)
+        return {k: getReference(self.obj[k]) for k in all_keys}
     
     def __str__(self):
         return f"{self.__class__.__name__} Name:{self.get('m_Name')} Type:{self.get('_type')} @{self.get('_folderName')}#{self.get('_pathId')}"
@@ -247,12 +836,14 @@ class HSMonoBehaviour():
     def __init__(self, obj, recursiveVerbs=False):
         super().__init__()
         self.obj = obj
-        self.dict = {  
-            "__pyclass": self.__class__.__name__
-        }
+        self.dict = {}
+        if stage_trace is not None:
+            stage_trace.classes.add(self.__class__.__name__)
+
+        schema = self.schema or self.compileSchema(self)
 
         all_keys = set(obj.keys())
-        known_keys = set(self.keys_typed.keys()).union(self.keys_simple)
+        known_keys = schema.known
 
         # If there are expect keys this object doesn't have
         if not (all_keys >= known_keys):
@@ -266,47 +857,23 @@ class HSMonoBehaviour():
         try:
             k = None
             t = None
-            i = None
 
-            for k, t in self.keys_typed.items():
+            for k, t in schema.typed:
                 if k not in obj:
                     continue
-                all_keys.remove(k)
 
                 if k == '_verbs' and not recursiveVerbs:
                     self.dict[k] = "[OMMITTED]"
                     continue
 
-                if isinstance(obj[k], list):
-                    self.dict[k] = [
-                        t(getReference(o)) if o else o
-                        for i, o in enumerate(obj[k])
-                    ]
-                    i = None
+                if self.LAZY:
+                    self.dict[k] = HSPending(t, obj[k])
                 else:
-                    ref = getReference(obj[k])
-
-                    if ref is None:
-                        # References null
-                        self.dict[k] = None
-                    else:
-                        self.dict[k] = t(ref)
-
-            for k in self.keys_simple:
-                if k not in obj:
-                    continue
-                all_keys.remove(k)
-
-                self.dict[k] = getReference(obj[k])
+                    self.dict[k] = resolveTyped(t, obj[k])
 
-            if all_keys:
-                self.dict['__unused'] = {}
-            for k in all_keys:
-                self.dict['__unused'][k] = getReference(obj[k])
-        
         except (KeyError, AssertionError, RecursionError) as e:
             print(e.__class__.__name__, e)
-            print(self, k, t, i)
+            print(self, k, t)
             # pprint.pprint(obj)
             print()
             raise
@@ -320,7 +887,7 @@ class HSMonoBehaviour():
         if self.DEBUG:
             for k, v in obj.items():
                 category_name = self.__class__.__name__
-                if (k in self.keys_simple) or (k in self.keys_typed):
+                if k in known_keys:
                     category_name += " (known)"
 
                 # print(category_name, k, v)
@@ -338,17 +905,33 @@ class HSMonoBehaviour():
                         EXAMPLES[category_name][k] = v
 
     def toDict(self):
-        flat_dict = {}
-        for k, v in self.dict.items():
-            if hasattr(v, 'toDict'):
-                flat_dict[k] = v.toDict()
-            elif isinstance(v, list):
-                flat_dict[k] = [i.toDict() if hasattr(i, 'toDict') else i for i in v]
-            else:
-                flat_dict[k] = v
+        schema = self.schema
+        fields = [k for k in list(self.dict) if k in schema.known]
+        fields += [k for k in schema.simple if k in self.obj]
+        unused = self.unused()
+        # Fields set after construction (HSImportTarget) came after __unused
+        extra = [k for k in list(self.dict) if k not in schema.known]
+
+        flat_dict = {
+            "__pyclass": self.__class__.__name__
+        }
+        for k in fields:
+            flat_dict[k] = self.flatten(self.get(k))
+        if unused:
+            flat_dict['__unused'] = unused
+        for k in extra:
+            flat_dict[k] = self.flatten(self.get(k))
 
         return flat_dict
 
+    @staticmethod
+    def flatten(v):
+        if hasattr(v, 'toDict'):
+            return v.toDict()
+        elif isinstance(v, list):
+            return [i.toDict() if hasattr(i, 'toDict') else i for i in v]
+        return v
+
     def toDictRoot(self):
         global visited
         visited.clear()
@@ -385,18 +968,22 @@ class HSRoot(HSMonoBehaviour):
 #         return self.instance.get(key)
 
 class HSAsset():
+    __slots__ = ("obj", "path")
+
     def __init__(self, obj, asset_type="*"):
         self.obj = obj
 
         archive_name = self.obj['m_FileName']
         path_id = self.obj['m_PathID']
 
-        matches = glob.glob(os.path.join(game_root, archive_name, asset_type, f"*#{path_id}.*"))
+        matches = lookupFile(archive_name, path_id, asset_type)
         assert len(matches) == 1, matches
-        self.path = matches[0].replace("\\", "/")
+        self.path = os.path.join(game_root, matches[0]).replace("\\", "/")
 
     @classmethod
+    @lru_cache(None)
     def typed(cls, arg):
+        # Cached so the same callable (and typed_instances key) is returned each time
         return lambda obj: cls(obj, asset_type=arg)
 
     def toDict(self):
@@ -593,6 +1180,7 @@ class HSConversation(HSMonoBehaviour):
             'OrphanedLines': HSConvoLines,
         })
 
+    @cachedTranscript
     def toTranscriptBody(self):
         convo_lines = []
 
@@ -602,7 +1190,8 @@ class HSConversation(HSMonoBehaviour):
         )
 
         # Start item
-        yield f"<div class='convo' id='{self.get('ConvoId').get('IdString')}'>"
+        convo_id = self.get('ConvoId').get('IdString')
+        yield f"<div class='convo' id='{convo_id}'>"
 
         if has_jump:
             yield "<ol>"
@@ -626,12 +1215,14 @@ class HSConversation(HSMonoBehaviour):
                 yield "(CHOICE)"
 
             # LOCALIZABLE
+            indexText(self, "line", line.get('LineText'), convo_id)
             yield f"<span class='speakername'>{SpeakerIdTypes[line.get('SpeakerId')]}</span> {line.get('LineText')}"
 
             # Link mappings for galekh
             if links := line.get("LinkMappings"):
                 for link in links:
                     # LOCALIZABLE
+                    indexText(self, "footnote", link.get('MessageText'), convo_id)
                     yield f"<span class='footnote'>{link.get('LinkIndex')}: {link.get('MessageText')}</span>"
 
             # "Jump" notifier
@@ -682,12 +1273,12 @@ class HSTriggerVolume(HSRoot):
 
     def toTranscriptBody(self):
         if onEnter := self.get("OnEnterSequence"):
-            if body_lines := list(onEnter.toTranscriptBody()):
+            if body_lines := peek(onEnter.toTranscriptBody()):
                 yield "<h2>On Enter</h2>"
                 yield from block(body_lines)
 
         if onExit := self.get("onExitSequence"):
-            if body_lines := list(onExit.toTranscriptBody()):
+            if body_lines := peek(onExit.toTranscriptBody()):
                 yield "<h2>On Exit</h2>"
                 yield from block(body_lines)
 
@@ -720,6 +1311,7 @@ class HSCondition(HSMonoBehaviour):
             'MustNotHaveTargetedObjs': HSTarget
         })
 
+    @cachedTranscript
     def toTranscriptBody(self):
         lines = []
 
@@ -832,11 +1424,13 @@ class HSEvidence(HSMonoBehaviour):
             yield "<ol class='evidence_descriptions'>"
             for i, d in enumerate(descriptions):
                 # LOCALIZABLE
+                indexText(self, "description", d)
                 yield f"<li>{d}</li>"
             yield "</ol>"
         else:
             for d in descriptions:
                 # LOCALIZABLE
+                indexText(self, "description", d)
                 yield d
         yield "</p>"
 
@@ -1095,6 +1689,7 @@ class HSHeaderMessage(HSMonoBehaviour):
         ]:
             color_d = self.get(color_k)
             color = f"rgb{color_d['r']*255, color_d['g']*255, color_d['b']*255}"
+            indexText(self, "header", self.get(linekey))
             v = f"<span class='headermessage' style='color: {color};'>" + self.get(linekey) + "</span>"
             if v:
                 yield _transform(v)
@@ -1197,12 +1792,12 @@ class HSSceneManager(HSRoot):
     
     def toTranscriptBody(self):
         outcome = self.get("PreArrivalOutcome")
-        if body := list(outcome.toTranscriptBody()):
+        if body := peek(outcome.toTranscriptBody()):
             yield "<h2>Before arrival</h2>"
             yield from body
 
         outcome = self.get("_arrivalOutcome")
-        if body := list(outcome.toTranscriptBody()):
+        if body := peek(outcome.toTranscriptBody()):
             yield "<h2>On arrival</h2>"
             yield from body
 
@@ -1221,7 +1816,9 @@ class HSImportTarget(HSMonoBehaviour):
     }
 
     @classmethod
+    @lru_cache(None)
     def resolve(cls, field):
+        # Cached so the same callable (and typed_instances key) is returned each time
         if field == "Hero":
             return HSHeroTarget
 
@@ -1239,7 +1836,7 @@ class HSImportTarget(HSMonoBehaviour):
                 # References null
                 ret.dict[k] = None
             else:
-                ret.dict[k] = t(ref)
+                ret.dict[k] = typedInstance(t, ref)
 
             return ret
         return _resolve
@@ -1274,6 +1871,7 @@ class HSImportTarget(HSMonoBehaviour):
         for message in self.get("ImportedInteractMessage", []):
             # Hero targets don't have field
             # LOCALIZABLE
+            indexText(self, "message", message)
             yield "<span class='condition always'>Default (imported)</span>"
             yield from block([f"<p class='message'>{message}</p>"], "conditionalbody")
 
@@ -1303,7 +1901,8 @@ class HSVerb(HSMonoBehaviour):
         })
 
     def toTranscriptBody(self, parent_name=None):
-        lines = []
+        # Set before anything is yielded, for the empty-body check at the end
+        has_body = False
         verb_clause = f"{self.get('_name')} {parent_name}" if self.get('_name') != parent_name else parent_name
 
         # Determine "default message"
@@ -1315,8 +1914,10 @@ class HSVerb(HSMonoBehaviour):
             *self.get('_heroTargets'),
             # *self.get('_interactableTargets')
         ]
+        # Each target is rendered once, here and for the output below
+        rendered = {id(target): list(target.toTranscriptBody()) for target in all_targets}
         for target in all_targets:
-            transcript = "\n".join(target.toTranscriptBody())
+            transcript = "\n".join(rendered[id(target)])
             message_counter[transcript] += 1
 
         try:
@@ -1328,10 +1929,11 @@ class HSVerb(HSMonoBehaviour):
         for target in self.get('_abilityTargets'):
             # LOCALIZABLE
             target_name = target.get('Ability').get('_displayName')
-            lines.append(f"<h2 class='verb abilitytarget'>{verb_clause} with {target_name}</h2>\n")
+            has_body = True
+            yield f"<h2 class='verb abilitytarget'>{verb_clause} with {target_name}</h2>\n"
 
-            lines += target.toTranscriptBody()
-            lines.append("")
+            yield from rendered[id(target)]
+            yield ""
 
         for target in self.get('_itemTargets'):
             # Some target Item references are null; deleted items?
@@ -1341,24 +1943,26 @@ class HSVerb(HSMonoBehaviour):
                 target_name = "[deleted item]"
 
             # If the item is deleted and the transcript is the default, skip it
-            target_transcript = target.toTranscriptBody()
+            target_transcript = iter(rendered[id(target)])
             if target_name == "[deleted item]" and "\n".join(target_transcript) == default_message:
                 continue
             else:
-                lines.append(f"<h2 class='verb itemtarget'>{verb_clause} with {target_name}</h2>\n")
-                lines += target_transcript
-                lines.append("")
+                has_body = True
+                yield f"<h2 class='verb itemtarget'>{verb_clause} with {target_name}</h2>\n"
+                yield from target_transcript
+                yield ""
 
         for target in self.get('_heroTargets'):
             target_name = target.get('Hero').get('m_Name')
-            transcript = target.toTranscriptBody()
+            transcript = iter(rendered[id(target)])
             # Only a couple instances of this (joey tap dance), both null
 
             if transcript:
-                lines.append(f"<h2 class='verb herotarget'>{verb_clause} with {target_name}</h2>\n")
+                has_body = True
+                yield f"<h2 class='verb herotarget'>{verb_clause} with {target_name}</h2>\n"
 
-                lines += transcript
-                lines.append("")
+                yield from transcript
+                yield ""
 
         # TODO interactable targets
         for target in self.get('_interactableTargets'):
@@ -1372,34 +1976,36 @@ class HSVerb(HSMonoBehaviour):
             # Only a couple instances of this (joey tap dance), both null
 
             if transcript:
-                lines.append(f"<h2 class='verb interactabletarget'>{verb_clause} with {target_name}</h2>\n")
+                has_body = True
+                yield f"<h2 class='verb interactabletarget'>{verb_clause} with {target_name}</h2>\n"
 
-                lines += transcript
-                lines.append("")
+                yield from transcript
+                yield ""
 
         outcome = self.get('_outcome')
         if outcome:
             sub_transcript = outcome.toTranscriptBody()
             if sub_transcript:
-                lines.append(f"<h2 class='verb notarget'>{verb_clause}</h2>\n")
+                has_body = True
+                yield f"<h2 class='verb notarget'>{verb_clause}</h2>\n"
 
-                lines += sub_transcript
-                lines.append("")
+                yield from sub_transcript
+                yield ""
 
         defaultTargetFail = self.get('_defaultTargetFail')
         if defaultTargetFail:
             sub_transcript = defaultTargetFail.toTranscriptBody()
             if list(sub_transcript):
-                lines.append(f"<h2 class='verb notarget fail'>{verb_clause}</h2>\n")
+                has_body = True
+                yield f"<h2 class='verb notarget fail'>{verb_clause}</h2>\n"
 
-                lines += sub_transcript
-                lines.append("")
+                yield from sub_transcript
+                yield ""
 
-        if not lines:
+        if not has_body:
             # If there's no body, record debugging info
-            lines.append(f"## {verb_clause} (Empty)\n")
-            lines.append(pprint.pformat(self.dict) + "\n")
-        yield from lines
+            yield f"## {verb_clause} (Empty)\n"
+            yield pprint.pformat(self.toDict()) + "\n"
 
 # Outcomes
 
@@ -1516,9 +2122,9 @@ class HSOutcomeSequence(HSRoot):
         if condition:
 
             # TODO: Ordering?
-            block_lines = []
-            for outcome in self.get("ActionsList"):
-                block_lines += list(outcome.toTranscriptBody())
+            block_lines = peek(itertools.chain.from_iterable(
+                outcome.toTranscriptBody() for outcome in self.get("ActionsList")
+            ))
 
             if block_lines:
                 yield from condition
@@ -1675,6 +2281,210 @@ class HSOutcomeSwitchCameraTarget(HSMonoBehaviour):
         # LOCALIZABLE
         yield f"(Move camera to {self.get('CameraPanTarget')})"
 
+def pruneConnections(adj_list, rootkey='START'):
+    # Replace the "con_" entries of every list reachable from rootkey with
+    # what they connect to, in place. Gives the same lists, in the same
+    # order, as pruneConnectionsRecursive, but prunes each key once and
+    # without recursion or list.remove.
+    #
+    # Each frame is [key, resolved entries, entries left, removed connections].
+    # A connection's entries are read when it is reached, so whether it
+    # was already pruned decides the order, like it did in the recursive one
+    pruned = set()
+
+    def frame(key):
+        pruned.add(key)
+        return [key, [], collections.deque(adj_list[key]), []]
+
+    stack = [frame(rootkey)]
+    while stack:
+        key, resolved, left, removed = stack[-1]
+
+        if left:
+            dstkey = left.popleft()
+            if dstkey.startswith("con_"):
+                left.extend(adj_list[dstkey])
+                removed.append(dstkey)
+            else:
+                resolved.append(dstkey)
+                if dstkey not in pruned:
+                    stack.append(frame(dstkey))
+            continue
+
+        if left is not None:
+            adj_list[key][:] = resolved
+            stack[-1][2] = None
+
+        # Removed connections are pruned last, most recent first
+        while removed:
+            conkey = removed.pop()
+            if conkey not in pruned:
+                stack.append(frame(conkey))
+                break
+        else:
+            stack.pop()
+
+def pruneConnectionsRecursive(adj_list, rootkey='START'):
+    # Original implementation, kept to check pruneConnections against
+    def _pruneCons(rootkey='START'):
+        # Bottom-up parsing
+        for dstkey in adj_list[rootkey]:
+            if dstkey.startswith("con_"):
+                # Connection
+                adj_list[rootkey].remove(dstkey)
+                adj_list[rootkey] += adj_list[dstkey]
+                _pruneCons(rootkey)  # changed adj_list[rootkey] mid-iteration
+            _pruneCons(dstkey)
+
+    _pruneCons(rootkey)
+
+def traverseNodeGraph(adj_list, rootkey='START'):
+    # Every edge reachable from rootkey once, as (src, dst), depth first in
+    # adjacency order; same order as traverseNodeGraphRecursive
+    visited = set()
+    stack = [(rootkey, iter(adj_list[rootkey]))]
+    while stack:
+        srckey, dstkeys = stack[-1]
+        for dstkey in dstkeys:
+            pathkey = (srckey, dstkey)
+            if pathkey not in visited:
+                visited.add(pathkey)
+                yield pathkey
+                stack.append((dstkey, iter(adj_list[dstkey])))
+                break
+        else:
+            stack.pop()
+
+def traverseNodeGraphRecursive(adj_list, rootkey='START', visited=None):
+    # Original implementation, kept to check traverseNodeGraph against
+    if visited is None:
+        visited = list()
+    for dstkey in adj_list[rootkey]:
+        pathkey = (rootkey, dstkey)
+        if pathkey in visited:
+            continue
+        else:
+            visited.append(pathkey)
+            yield pathkey
+            yield from traverseNodeGraphRecursive(adj_list, dstkey, visited)
+
+def syntheticCanvas(node_count, seed=0, fanout=2):
+    # adj_list shaped like HSOutcomeCanvas builds it: START -> nodes without
+    # inputs, node -> its outputs, output -> connected inputs, input -> node
+    rng = random.Random(seed)
+    adj_list = collections.defaultdict(list)
+    targeted = set()
+    outputs = {}
+    for n in range(node_count):
+        outputs[n] = []
+        for j in range(rng.randint(1, fanout)):
+            out_key = f"con_out.{n}.{j}"
+            outputs[n].append(out_key)
+            later = range(n + 1, min(node_count, n + 1 + 4 * fanout))
+            if later:
+                for m in rng.sample(later, min(len(later), rng.randint(1, fanout))):
+                    adj_list[out_key].append(f"con_in.{m}")
+                    targeted.add(m)
+
+    for n in range(node_count):
+        node_key = f"OutcomeSequence.synthetic.{n}"
+        if n in targeted:
+            adj_list[f"con_in.{n}"].append(node_key)
+        else:
+            adj_list['START'].append(node_key)
+        adj_list[node_key] += outputs[n]
+    return adj_list
+
+def benchmarkCanvas(sizes=(1000, 5000, 20000), check_size=12, checks=200):
+    # Pruning and traversal must match the recursive versions exactly.
+    # Those are exponential (pruning) or quadratic (traversal) on big
+    # canvases, so that is only checked on small ones. Big canvases are
+    # checked against a plain contraction of their connections instead
+    def contractConnections(adj_list, key):
+        # Keys reachable from key through connections only
+        found, seen = set(), set()
+        stack = list(adj_list[key])
+        while stack:
+            dstkey = stack.pop()
+            if not dstkey.startswith("con_"):
+                found.add(dstkey)
+            elif dstkey not in seen:
+                seen.add(dstkey)
+                stack += adj_list[dstkey]
+        return found
+
+    for seed in range(checks):
+        expected = syntheticCanvas(check_size, seed)
+        actual = syntheticCanvas(check_size, seed)
+        pruneConnectionsRecursive(expected)
+        pruneConnections(actual)
+        assert dict(actual) == dict(expected), seed
+        for rootkey in ['START'] + expected['START']:
+            assert list(traverseNodeGraph(actual, rootkey)) == list(traverseNodeGraphRecursive(expected, rootkey)), seed
+
+    for size in sizes:
+        original = syntheticCanvas(size, fanout=3)
+        adj_list = syntheticCanvas(size, fanout=3)
+        start = time.perf_counter()
+        pruneConnections(adj_list)
+        pruned = time.perf_counter()
+        edges = list(traverseNodeGraph(adj_list))
+        traversed = time.perf_counter()
+        print(f"{size:>8} nodes: prune {pruned - start:.3f}s, traverse {traversed - pruned:.3f}s ({len(edges)} edges)")
+
+        reachable = {'START'} | {dstkey for (srckey, dstkey) in edges}
+        assert len(reachable) == size + 1, size
+        assert len(edges) == len(set(edges)), size
+        for key in reachable:
+            assert not any(dstkey.startswith("con_") for dstkey in adj_list[key]), key
+            assert set(adj_list[key]) == contractConnections(original, key), key
+
+class CompiledCanvas():
+    # What HSOutcomeCanvas renders from its node graph, worked out once:
+    #   nodes_by_key[node_key] -> node
+    #   adj_list: node graph with connections pruned
+    #   edges: [(src, dst), ...] reachable from START, for the mermaid chart
+    #   starters: [(starter_key, [node_key, ...]), ...] nodes in the order
+    #     each starter's body lists them
+
+    def __init__(self, nodes):
+        adj_list = collections.defaultdict(list)
+        nodes_by_key = {}
+
+        for node in nodes:
+            node_key = f"{node.get('_type')}.{node.get('_folderName')}.{node.get('_pathId')}"
+            nodes_by_key[node_key] = node
+
+            for input_node in node.get("Inputs"):
+                in_key = f"con_{input_node.get('m_FileName')}.{input_node.get('m_PathID')}"
+                adj_list[in_key].append(node_key)
+
+            if not node.get("Inputs"):
+                adj_list['START'].append(node_key)
+
+            for output_node in node.get("Outputs"):
+                out_key = f"con_{output_node.get('_folderName')}.{output_node.get('_pathId')}"
+                adj_list[node_key].append(out_key)
+
+                for output_connection in output_node.get("connections"):
+                    con_key = f"con_{output_connection.get('m_FileName')}.{output_connection.get('m_PathID')}"
+                    adj_list[out_key].append(con_key)
+                    # adj_list[con_key].append(node_key)
+
+        pruneConnections(adj_list)
+
+        self.nodes_by_key = nodes_by_key
+        self.adj_list = adj_list
+        self.edges = list(traverseNodeGraph(adj_list))
+        self.starters = [
+            (starter_key, [nodekey for prevkey, nodekey in traverseNodeGraph(adj_list, rootkey=starter_key)])
+            for starter_key in adj_list['START']
+        ]
+
+    @property
+    def mermaid(self):
+        return "graph LR\n" + "\n".join(f"  {srckey}-->{dstkey}" for srckey, dstkey in self.edges)
+
 class HSOutcomeCanvas(HSRoot):
     @property
     def keys_simple(self):
@@ -1693,9 +2503,16 @@ class HSOutcomeCanvas(HSRoot):
     def title(self):
         return f"{self.get('_folderName')} OutcomeCanvas#{self.get('_pathId')}"
 
+    def compiled(self):
+        try:
+            return compiled_canvases[self.key]
+        except KeyError:
+            canvas = compiled_canvases[self.key] = CompiledCanvas(self.get('nodes'))
+            return canvas
+
+    @cachedTranscript
     def toTranscriptBody(self):
-        global outcomes_seen
-        outcomes_seen.add(self.key)
+        markOutcomesSeen([self.key])
 
         yield f"<!-- {self} -->"
         # LOCALIZABLE
@@ -1739,82 +2556,27 @@ class HSOutcomeCanvas(HSRoot):
         # yield "</div>"
 
         # Actual implementation
-        adj_list = collections.defaultdict(list)
-        nodes_by_key = {}
-            # (node.get('_folderName'), node.get('_pathId')): node
-            # for node in self.get('nodes')
-        # }
-
-        for node in self.get('nodes'):
-
-            node_key = f"{node.get('_type')}.{node.get('_folderName')}.{node.get('_pathId')}"
-            nodes_by_key[node_key] = node
-
-            for input_node in node.get("Inputs"):
-                in_key = f"con_{input_node.get('m_FileName')}.{input_node.get('m_PathID')}"
-                adj_list[in_key].append(node_key)
-
-            if not node.get("Inputs"):
-                adj_list['START'].append(node_key)
-
-            for output_node in node.get("Outputs"):
-                out_key = f"con_{output_node.get('_folderName')}.{output_node.get('_pathId')}"
-                adj_list[node_key].append(out_key)
-
-                for output_connection in output_node.get("connections"):
-                    con_key = f"con_{output_connection.get('m_FileName')}.{output_connection.get('m_PathID')}"
-                    adj_list[out_key].append(con_key)
-                    # adj_list[con_key].append(node_key)
-
-        def _pruneCons(rootkey='START'):
-            # TODO: Not sure which is more efficient
-
-            # Bottom-up parsing
-            for dstkey in adj_list[rootkey]:
-                if dstkey.startswith("con_"):
-                    # Connection
-                    adj_list[rootkey].remove(dstkey)
-                    adj_list[rootkey] += adj_list[dstkey]
-                    _pruneCons(rootkey)  # changed adj_list[rootkey] mid-iteration
-                _pruneCons(dstkey)
-
-            # for conkey in adj_list:
-            #     if conkey.startswith("con_"):
-            #         for srckey in adj_list:
-            #             if conkey in adj_list[srckey]:
-            #                 # srckey connects to con
-            #                 adj_list[srckey] += adj_list[conkey]
-            #                 adj_list[srckey].remove(conkey)
-
-        def _traverseNodeGraph(rootkey='START', visited=None):
-            if visited is None:
-                visited = list()
-            for dstkey in adj_list[rootkey]:
-                pathkey = (rootkey, dstkey)
-                if pathkey in visited:
-                    continue
-                else:
-                    visited.append(pathkey)
-                    yield pathkey
-                    yield from _traverseNodeGraph(dstkey, visited)
-
-        _pruneCons()
+        canvas = self.compiled()
 
-        yield "<div class='mermaid'>graph LR"
-        for srckey, dstkey in _traverseNodeGraph():
-            yield f"  {srckey}-->{dstkey}"
-        yield "</div>"
+        if MERMAID_PRERENDER:
+            key = mermaid_cache.add(canvas.mermaid)
+            yield f"<img class='mermaid' src='{MERMAID_DIR}/{key}.svg'>"
+        else:
+            yield "<div class='mermaid'>graph LR"
+            for srckey, dstkey in canvas.edges:
+                yield f"  {srckey}-->{dstkey}"
+            yield "</div>"
 
         # Note: This is *a* valid order, not actually the correct one.
         # No good way to easily express simultaneous events in a transcript
 
         # Maybe try to put "long" events later? urgh
 
-        for starter_key in adj_list['START']:
+        for starter_key, order in canvas.starters:
             yield "<div class='nodebody'>"
-            yield from nodes_by_key[starter_key].toTranscriptBody()
-            for prevkey, nodekey in _traverseNodeGraph(rootkey=starter_key):
-                yield from nodes_by_key[nodekey].toTranscriptBody()
+            yield from canvas.nodes_by_key[starter_key].toTranscriptBody()
+            for nodekey in order:
+                yield from canvas.nodes_by_key[nodekey].toTranscriptBody()
             yield "</div>"
 
 class HSOutcomeChangeScene(HSMonoBehaviour):
@@ -1944,6 +2706,7 @@ class HSOutcomeMessage(HSMonoBehaviour):
     def toTranscriptBody(self):
         for message in self.get("Messages"):
             # LOCALIZABLE
+            indexText(self, "message", message)
             yield f"<p class='message'>{message}</p>"
 
 class HSOutcomeAnimation(HSMonoBehaviour):
@@ -2217,96 +2980,284 @@ HTML_META = """
 </script>
 """
 
+# Same page head without the mermaid script, for prerendered charts
+HTML_META_STATIC = """
+<link rel="stylesheet" href="transcript.css"></link>
+"""
+
+def htmlMeta():
+    return HTML_META_STATIC if MERMAID_PRERENDER else HTML_META
+
+mermaid_cache = MermaidCache(MERMAID_DIR, MERMAID_RENDERER)
+
 # Calculate reference graph
 
-def ddictlist():
-    # module level function, picklable
-    return collections.defaultdict(list)
-
-def findRefs(x, name=""):
-    if isinstance(x, dict):
-        if 'm_FileName' in x:
-            id_ = FileID(x['m_FileName'], str(x['m_PathID']))
-            yield (id_, name)
-        for k, v in x.items():
-            yield from findRefs(v, name=name + "." + k)
-    elif isinstance(x, list):
-        for v in x:
-            yield from findRefs(v, name=name)
-
-
-FileID = collections.namedtuple("FileID", ["fileName", "pathId"])
-file_paths = sorted(glob.glob(game_root + "/*/MonoBehaviour/*"))
-
-referencesFrom = collections.defaultdict(list)
-referencedBy = collections.defaultdict(list)
-referencedAs = collections.defaultdict(ddictlist)
-
-reference_cache_filepath = "scriptrefs.pickle"
-try:
-    with open(reference_cache_filepath, "rb") as fp:
-        (referencesFrom, referencedBy, referencedAs) = pickle.load(fp)
-    print("Loaded cached references")
-except (FileNotFoundError, EOFError):
-    print("Building references...")
-    for path in tqdm(file_paths):
-        (folder_name, path_id) = re.match(r".+?([^\/]*)\/[^\/]+\/[^\/]+\#(\d+)\.json", path.replace("\\", "/")).groups()
-        source = FileID(folder_name, path_id)
-        with open(os.path.join(path), 'r', encoding="utf-8") as fp:
-            parsed = json.load(fp)
-
-        # todo make this faster
-        for target, refd_as in findRefs(parsed):
-            if target.fileName is not None:
-                referencesFrom[source].append(target)
-                referencedBy[target].append(source)
-                referencedAs[target][source].append(refd_as)
-
-    with open(reference_cache_filepath, "wb") as fp:
-        tup = (referencesFrom, referencedBy, referencedAs,)
-        pickle.dump(tup, fp)
+def benchmarkFindRefs(sample_size=2000, rounds=5):
+    sample = []
+    for (path, folder_name, path_id, utype) in itertools.islice(iterAssetPaths(), sample_size):
+        with open(path, "rb") as fp:
+            sample.append(jsonLoad(fp))
+    print(f"Extracting references from {len(sample)} assets, {rounds} rounds")
+
+    for o in sample:
+        assert list(findRefs(o)) == list(findRefsRecursive(o)), o
+
+    for impl in [findRefsRecursive, findRefs]:
+        start = time.perf_counter()
+        count = 0
+        for _ in range(rounds):
+            for o in sample:
+                for ref in impl(o):
+                    count += 1
+        elapsed = time.perf_counter() - start
+        print(f"{impl.__name__:>18}: {elapsed:.3f}s ({count // rounds} refs/round)")
+
+
+references = ReferenceGraph("scriptrefs.refgraph", game_root, records=iterArchiveFiles, compact=True)
 
 
 def getReferencesHtml(file_id):
-    if file_id not in referencedBy:
+    if file_id not in references.referencedBy:
         print(repr(file_id))
         return '<p>No references to this file</p>'
 
-    return "<p>Referenced by:</p><ul>\n" + "\n".join(["<li>" + fileIdToName(ref) + " as " + ", ".join(referencedAs[file_id][ref]) + "</li>" for ref in set(referencedBy[file_id])]) + "</ul>"
+    names = references.referencedAs[file_id]
+    return "<p>Referenced by:</p><ul>\n" + "\n".join(["<li>" + fileIdToName(ref) + " as " + ", ".join(names[ref]) + "</li>" for ref in set(references.referencedBy[file_id])]) + "</ul>"
 
-@lru_cache(10000)
 def fileIdToName(ref):
-    target_glob = None
+    targetNames = None
     try:
         assert ref.fileName is not None
-        target_glob = os.path.join(game_root, ref.fileName, "*", f"*#{ref.pathId}.*")
-        targetNames = glob.glob(target_glob)
+        targetNames = lookupFile(ref.fileName, ref.pathId)
 
         assert len(targetNames) == 1
-        targetName = targetNames[0].replace('\\', '/')
+        targetName = os.path.join(game_root, targetNames[0]).replace('\\', '/')
         return targetName
     except (AssertionError, IndexError):
-        print(target_glob)
+        print(targetNames)
         print(ref)
         return f"Unknown! ({ref.fileName}/{ref.pathId})"
 
 # Operations
 
+def jsonOutputPath(path, fmt=None):
+    if (fmt or JSON_FORMAT) == "lines" and path.endswith(".json"):
+        return path + "l"
+    return path
+
+class JsonRootWriter():
+    # Writes a list of root objects one at a time, so only one root is
+    # flattened at once. "indent" output is the same as
+    # json.dump(roots, fp, indent=4)
+
+    def __init__(self, path, fmt=None):
+        self.format = fmt or JSON_FORMAT
+        self.path = jsonOutputPath(path, self.format)
+        self.fp = None
+        self.count = 0
+
+    def __enter__(self):
+        self.fp = open(self.path, "w", encoding="utf-8")
+        return self
+
+    def write(self, obj):
+        if self.format == "lines":
+            self.fp.write(json.dumps(obj) + "\n")
+        elif self.format == "compact":
+            self.fp.write(("[" if not self.count else ", ") + json.dumps(obj))
+        else:
+            self.fp.write(("[\n    " if not self.count else ",\n    ") + json.dumps(obj, indent=4).replace("\n", "\n    "))
+        self.count += 1
+
+    def __exit__(self, *exc):
+        if self.format != "lines":
+            if not self.count:
+                self.fp.write("[]")
+            else:
+                self.fp.write("]" if self.format == "compact" else "\n]")
+        self.fp.close()
+
+class TranscriptWriter():
+    # Buffered transcript file; bodies are written line by line as
+    # toTranscriptBody yields them instead of being joined first
+
+    def __init__(self, path, buffer_size=None):
+        self.path = path
+        self.buffer_size = buffer_size or TRANSCRIPT_BUFFER_SIZE
+        self.fp = None
+
+    def __enter__(self):
+        self.fp = open(self.path, "w", encoding="utf-8", buffering=self.buffer_size)
+        return self
+
+    def write(self, text):
+        self.fp.write(text)
+
+    def writeBody(self, lines):
+        # Same as write("\n".join(lines))
+        write = self.fp.write
+        it = iter(lines)
+        for line in it:
+            write(line)
+            break
+        for line in it:
+            write("\n")
+            write(line)
+
+    def beginItem(self, item):
+        # Called before each item is written
+        self.locate(item, os.path.basename(self.path))
+
+    def locate(self, item, page):
+        # Point search entries at item, and index its title
+        global search_location
+        search_location = SearchLocation(page, transcriptAnchor(item))
+        indexText(item, "title", item.title)
+
+    def __exit__(self, *exc):
+        global search_location
+        search_location = None
+        self.fp.close()
+
+class TranscriptShard():
+    # One shard file of a ShardedTranscriptWriter, written to a temp file
+    # and hashed as it goes
+
+    def __init__(self, path, label, buffer_size):
+        self.path = path
+        self.label = label
+        self.tmp_path = f"{path}.{os.getpid()}.tmp"
+        self.manifest_path = os.path.splitext(path)[0] + ".manifest.json"
+        self.fp = open(self.tmp_path, "w", encoding="utf-8", buffering=buffer_size)
+        self.hash = hashlib.sha1()
+        # [title, transcriptAnchor], as they are kept in the manifest
+        self.items = []
+
+    def write(self, text):
+        self.fp.write(text)
+        self.hash.update(text.encode("utf-8"))
+
+    def close(self):
+        # Replace the shard only if it changed, so it keeps its mtime
+        self.fp.close()
+        manifest = {
+            "file": os.path.basename(self.path),
+            "label": self.label,
+            "hash": self.hash.hexdigest(),
+            "items": self.items,
+        }
+        try:
+            with open(self.manifest_path, "rb") as fp:
+                unchanged = jsonLoad(fp) == manifest and os.path.isfile(self.path)
+        except (FileNotFoundError, ValueError):
+            unchanged = False
+
+        if unchanged:
+            os.remove(self.tmp_path)
+        else:
+            os.replace(self.tmp_path, self.path)
+            with open(self.manifest_path, "w", encoding="utf-8") as fp:
+                json.dump(manifest, fp, indent=4)
+        return manifest
+
+    def discard(self):
+        self.fp.close()
+        os.remove(self.tmp_path)
+
+class ShardedTranscriptWriter(TranscriptWriter):
+    # Transcript split into <stem>.<shard>.html files, each next to a
+    # <stem>.<shard>.manifest.json, with path itself an index page.
+    # Whatever is written before the first item (the page head) starts
+    # every shard. Shards that are no longer produced are removed
+
+    def __init__(self, path, shards, buffer_size=None):
+        super().__init__(path, buffer_size)
+        self.stem = os.path.splitext(path)[0]
+        self.shards = shards
+        self.open_shards = {}
+        self.count = 0
+
+    def __enter__(self):
+        self.fp = self.head = io.StringIO()
+        return self
+
+    def shardKey(self, item):
+        if self.shards == "scene":
+            folder_name = item.obj.get('_folderName') or "misc"
+            return (folder_name, SceneNameInBuildSettings.get(folder_name, folder_name))
+        start = self.count // self.shards * self.shards
+        return (f"{self.count // self.shards:04d}", f"Items {start + 1}-{start + self.shards}")
+
+    def beginItem(self, item):
+        key, label = self.shardKey(item)
+        shard = self.open_shards.get(key)
+        if shard is None:
+            shard = self.open_shards[key] = TranscriptShard(f"{self.stem}.{key}.html", label, self.buffer_size)
+            shard.write(self.head.getvalue())
+        shard.items.append([item.title, transcriptAnchor(item)])
+        self.fp = shard
+        self.count += 1
+        self.locate(item, os.path.basename(shard.path))
+
+    def __exit__(self, exc_type, *exc):
+        global search_location
+        search_location = None
+        if exc_type is not None:
+            for shard in self.open_shards.values():
+                shard.discard()
+            return
+
+        manifests = [shard.close() for key, shard in sorted(self.open_shards.items())]
+        if stage_trace is not None:
+            stage_trace.outputs.update(shard.path for shard in self.open_shards.values())
+
+        written = {os.path.basename(shard.manifest_path) for shard in self.open_shards.values()}
+        for manifest_path in glob.glob(glob.escape(self.stem) + ".*.manifest.json"):
+            if os.path.basename(manifest_path) not in written:
+                os.remove(manifest_path)
+                stale_path = manifest_path[:-len(".manifest.json")] + ".html"
+                if os.path.isfile(stale_path):
+                    os.remove(stale_path)
+
+        with open(self.path, "w", encoding="utf-8") as fp:
+            fp.write(self.head.getvalue())
+            fp.write(f"<h1>{os.path.basename(self.stem)}</h1>\n\n")
+            for manifest in manifests:
+                fp.write(f"<h2><a href='{quote(manifest['file'])}'>{manifest['label']}</a></h2>\n<ul>\n")
+                for title, anchor in manifest["items"]:
+                    fp.write(f"<li><a href='{quote(manifest['file'])}#{anchor}'>{title}</a></li>\n")
+                fp.write("</ul>\n\n")
+
+def transcriptWriter(path):
+    if TRANSCRIPT_SHARDS:
+        return ShardedTranscriptWriter(path, TRANSCRIPT_SHARDS)
+    return TranscriptWriter(path)
+
+def transcriptAnchor(item):
+    # id of the heading of an item in its transcript
+    return f"{item.obj.get('_folderName')}-{item.obj.get('_pathId')}"
+
+SearchLocation = collections.namedtuple("SearchLocation", ["page", "anchor"])
+def dumpJsonRoots(path, roots):
+    with JsonRootWriter(path) as writer:
+        for root in roots:
+            writer.write(root.toDictRoot())
+
 def dumpItems():
     print("Dumping items")
 
-    All_Items = [HSItem(o, recursiveVerbs=True) for o in iterArchiveFiles() if 'ItemID' in o]
+    All_Items = [HSItem(o, recursiveVerbs=True) for o in iterArchiveFiles(marker='ItemID')]
     All_Items.sort(key=lambda o: o.title)
 
-    with open("Items.json", "w", encoding="utf-8") as fp:
-        json.dump([i.toDictRoot() for i in All_Items], fp, indent=4)
+    dumpJsonRoots("Items.json", All_Items)
 
-    with open("ItemsTranscript.html", "w", encoding="utf-8") as fp:
-        fp.write(HTML_META)
+    with transcriptWriter("ItemsTranscript.html") as fp:
+        fp.write(htmlMeta())
         for item in All_Items:
             try:
-                fp.write(f"<h1>{item.title}\n\n")
-                fp.write("\n".join(item.toTranscriptBody()))
+                fp.beginItem(item)
+                fp.write(f"<h1 id='{transcriptAnchor(item)}'>{item.title}\n\n")
+                fp.writeBody(item.toTranscriptBody())
                 fp.write("\n\n")
             except Exception:
                 pprint.pprint(item.toTranscriptBody())
@@ -2315,17 +3266,17 @@ def dumpItems():
 def dumpEvidence():
     print("Dumping evidence")
 
-    All_Evidence = [HSEvidence(o, recursiveVerbs=True) for o in iterArchiveFiles() if 'PresentOutcomes' in o]
+    All_Evidence = [HSEvidence(o, recursiveVerbs=True) for o in iterArchiveFiles(marker='PresentOutcomes')]
 
-    with open("Evidence.json", "w", encoding="utf-8") as fp:
-        json.dump([i.toDictRoot() for i in All_Evidence], fp, indent=4)
+    dumpJsonRoots("Evidence.json", All_Evidence)
 
-    with open("EvidenceTranscript.html", "w", encoding="utf-8") as fp:
-        fp.write(HTML_META)
+    with transcriptWriter("EvidenceTranscript.html") as fp:
+        fp.write(htmlMeta())
         for item in All_Evidence:
             try:
-                fp.write(f"<h1>{item.title}</h1>\n\n")
-                fp.write("\n".join(item.toTranscriptBody()))
+                fp.beginItem(item)
+                fp.write(f"<h1 id='{transcriptAnchor(item)}'>{item.title}</h1>\n\n")
+                fp.writeBody(item.toTranscriptBody())
                 fp.write("\n\n")
             except Exception:
                 pprint.pprint(list(item.toTranscriptBody()))
@@ -2334,17 +3285,17 @@ def dumpEvidence():
 def dumpAbilities():
     print("Dumping abilities")
 
-    All_Abilities = [HSAbility(o, recursiveVerbs=True) for o in iterArchiveFiles() if 'AbilityID' in o]
+    All_Abilities = [HSAbility(o, recursiveVerbs=True) for o in iterArchiveFiles(marker='AbilityID')]
 
-    with open("Abilities.json", "w", encoding="utf-8") as fp:
-        json.dump([i.toDictRoot() for i in All_Abilities], fp, indent=4)
+    dumpJsonRoots("Abilities.json", All_Abilities)
 
-    with open("AbilitiesTranscript.html", "w", encoding="utf-8") as fp:
-        fp.write(HTML_META)
+    with transcriptWriter("AbilitiesTranscript.html") as fp:
+        fp.write(htmlMeta())
         for ability in All_Abilities:
             try:
-                fp.write(f"<h1>{ability.title}</h1>\n\n")
-                fp.write("\n".join(ability.toTranscriptBody()))
+                fp.beginItem(ability)
+                fp.write(f"<h1 id='{transcriptAnchor(ability)}'>{ability.title}</h1>\n\n")
+                fp.writeBody(ability.toTranscriptBody())
                 fp.write("\n\n")
             except Exception:
                 pprint.pprint(ability.toTranscriptBody())
@@ -2353,18 +3304,18 @@ def dumpAbilities():
 def dumpInteractables():
     print("Dumping interactables")
 
-    All_Interactables = [HSInteractable(o, recursiveVerbs=True) for o in iterArchiveFiles() if o.get("_type") == "Interactable"]
+    All_Interactables = [HSInteractable(o, recursiveVerbs=True) for o in iterArchiveFiles(utype="Interactable")]
     All_Interactables.sort(key=lambda o: o.title)
 
-    with open("Interactables.json", "w", encoding="utf-8") as fp:
-        json.dump([i.toDictRoot() for i in All_Interactables], fp, indent=4)
+    dumpJsonRoots("Interactables.json", All_Interactables)
 
-    with open("InteractablesTranscript.html", "w", encoding="utf-8") as fp:
-        fp.write(HTML_META)
+    with transcriptWriter("InteractablesTranscript.html") as fp:
+        fp.write(htmlMeta())
         for interactable in All_Interactables:
             try:
-                fp.write(f"<h1>{interactable.title}</h1>\n\n")
-                fp.write("\n".join(interactable.toTranscriptBody()))
+                fp.beginItem(interactable)
+                fp.write(f"<h1 id='{transcriptAnchor(interactable)}'>{interactable.title}</h1>\n\n")
+                fp.writeBody(interactable.toTranscriptBody())
                 fp.write("\n\n")
             except Exception:
                 pprint.pprint(list(interactable.toTranscriptBody()))
@@ -2373,18 +3324,18 @@ def dumpInteractables():
 def dumpScenes():
     print("Dumping scenes")
 
-    All_Scenes = [HSSceneManager(o, recursiveVerbs=True) for o in iterArchiveFiles() if o.get("_type") == "SceneManager"]
+    All_Scenes = [HSSceneManager(o, recursiveVerbs=True) for o in iterArchiveFiles(utype="SceneManager")]
     All_Scenes.sort(key=lambda o: o.title)
 
-    with open("Scenes.json", "w", encoding="utf-8") as fp:
-        json.dump([i.toDictRoot() for i in All_Scenes], fp, indent=4)
+    dumpJsonRoots("Scenes.json", All_Scenes)
 
-    with open("ScenesTranscript.html", "w", encoding="utf-8") as fp:
-        fp.write(HTML_META)
+    with transcriptWriter("ScenesTranscript.html") as fp:
+        fp.write(htmlMeta())
         for scenemgr in All_Scenes:
             try:
-                fp.write(f"<h1>{scenemgr.title}</h1>\n\n")
-                fp.write("\n".join(scenemgr.toTranscriptBody()))
+                fp.beginItem(scenemgr)
+                fp.write(f"<h1 id='{transcriptAnchor(scenemgr)}'>{scenemgr.title}</h1>\n\n")
+                fp.writeBody(scenemgr.toTranscriptBody())
                 fp.write("\n\n")
             except Exception:
                 pprint.pprint(list(scenemgr.toTranscriptBody()))
@@ -2393,18 +3344,18 @@ def dumpScenes():
 def dumpAnimOutcomes():
     print("Dumping animation outcomes")
 
-    All_OnEnter = [HSOutcomeOnStateEnter(o) for o in iterArchiveFiles() if o.get("_type") == "OutcomeOnStateEnter"]
+    All_OnEnter = [HSOutcomeOnStateEnter(o) for o in iterArchiveFiles(utype="OutcomeOnStateEnter")]
     All_OnEnter.sort(key=lambda o: (o.get('_folderName'), o.get('_pathId')))
 
-    with open("OutcomesOnEnter.json", "w", encoding="utf-8") as fp:
-        json.dump([i.toDictRoot() for i in All_OnEnter], fp, indent=4)
+    dumpJsonRoots("OutcomesOnEnter.json", All_OnEnter)
 
-    with open("OutcomesOnEnterTranscript.html", "w", encoding="utf-8") as fp:
-        fp.write(HTML_META)
+    with transcriptWriter("OutcomesOnEnterTranscript.html") as fp:
+        fp.write(htmlMeta())
         for outcome in All_OnEnter:
             try:
-                fp.write(f"<h1>{outcome.title}</h1>\n\n")
-                fp.write("\n".join(outcome.toTranscriptBody()))
+                fp.beginItem(outcome)
+                fp.write(f"<h1 id='{transcriptAnchor(outcome)}'>{outcome.title}</h1>\n\n")
+                fp.writeBody(outcome.toTranscriptBody())
                 fp.write("\n\n")
             except Exception:
                 pprint.pprint(list(outcome.toTranscriptBody()))
@@ -2413,18 +3364,18 @@ def dumpAnimOutcomes():
 def dumpTriggerVolumes():
     print("Dumping trigger volumes")
 
-    All_TriggerVolumes = [HSTriggerVolume(o) for o in iterArchiveFiles() if o.get("_type") == "TriggerVolume"]
+    All_TriggerVolumes = [HSTriggerVolume(o) for o in iterArchiveFiles(utype="TriggerVolume")]
     All_TriggerVolumes.sort(key=lambda o: (o.get('_folderName'), o.get('_pathId')))
 
-    with open("TriggerVolumes.json", "w", encoding="utf-8") as fp:
-        json.dump([i.toDictRoot() for i in All_TriggerVolumes], fp, indent=4)
+    dumpJsonRoots("TriggerVolumes.json", All_TriggerVolumes)
 
-    with open("TriggerVolumes.html", "w", encoding="utf-8") as fp:
-        fp.write(HTML_META)
+    with transcriptWriter("TriggerVolumes.html") as fp:
+        fp.write(htmlMeta())
         for trigger in All_TriggerVolumes:
             try:
-                fp.write(f"<h1>{trigger.title}</h1>\n\n")
-                fp.write("\n".join(trigger.toTranscriptBody()))
+                fp.beginItem(trigger)
+                fp.write(f"<h1 id='{transcriptAnchor(trigger)}'>{trigger.title}</h1>\n\n")
+                fp.writeBody(trigger.toTranscriptBody())
                 fp.write("\n\n")
             except Exception:
                 pprint.pprint(list(trigger.toTranscriptBody()))
@@ -2433,26 +3384,227 @@ def dumpTriggerVolumes():
 def dumpOutcomes():
     print("Dumping other outcomes")
 
-    All_Outcomes = [HSOutcomeCanvas(o) for o in iterArchiveFiles() if o.get("_type") == "OutcomeCanvas"]
+    All_Outcomes = [HSOutcomeCanvas(o) for o in iterArchiveFiles(utype="OutcomeCanvas")]
     All_Outcomes = [o for o in All_Outcomes if o.key not in outcomes_seen]
     All_Outcomes.sort(key=lambda o: (o.get('_folderName'), o.get('_pathId')))
 
-    with open("Outcomes.json", "w", encoding="utf-8") as fp:
-        json.dump([i.toDictRoot() for i in All_Outcomes], fp, indent=4)
+    dumpJsonRoots("Outcomes.json", All_Outcomes)
 
-    with open("OutcomesTranscript.html", "w", encoding="utf-8") as fp:
-        fp.write(HTML_META)
+    with transcriptWriter("OutcomesTranscript.html") as fp:
+        fp.write(htmlMeta())
         for outcome in All_Outcomes:
             try:
+                fp.beginItem(outcome)
                 file_id = FileID(outcome.get('_folderName'), outcome.get('_pathId'))
-                fp.write(f"<h1>{outcome.title}</h1>\n\n")
+                fp.write(f"<h1 id='{transcriptAnchor(outcome)}'>{outcome.title}</h1>\n\n")
                 fp.write(getReferencesHtml(file_id) + "\n")
-                fp.write("\n".join(outcome.toTranscriptBody()))
+                fp.writeBody(outcome.toTranscriptBody())
                 fp.write("\n\n")
             except Exception:
                 pprint.pprint(list(outcome.toTranscriptBody()))
                 raise
 
+# Records, HS classes and file lookups (archive, path_id, asset_type)
+# a dump stage used, and the files it wrote besides its declared outputs
+# (transcript shards), collected while it runs. Traces saved before files
+# and outputs were added load with none
+StageTrace = collections.namedtuple("StageTrace", ["records", "classes", "files", "outputs"], defaults=[(), ()])
+
+# A dump function and what it reads and writes. types and markers select
+# its root records; records those reference are traced when it runs.
+# state names shared inputs from STAGE_STATE
+DumpStage = collections.namedtuple("DumpStage", ["run", "types", "markers", "state", "outputs"])
+
+# Stages that only read the archives, so they can run in any order.
+# They fill outcomes_seen, which dumpOutcomes reads, so it always runs after
+DUMP_STAGES = [
+    DumpStage(dumpTriggerVolumes, ["TriggerVolume"], [], ["ConversationSpeakers"], ["TriggerVolumes.json", "TriggerVolumes.html"]),
+    DumpStage(dumpScenes, ["SceneManager"], [], ["ConversationSpeakers"], ["Scenes.json", "ScenesTranscript.html"]),
+    DumpStage(dumpItems, [], ["ItemID"], ["ConversationSpeakers"], ["Items.json", "ItemsTranscript.html"]),
+    DumpStage(dumpAbilities, [], ["AbilityID"], ["ConversationSpeakers"], ["Abilities.json", "AbilitiesTranscript.html"]),
+    DumpStage(dumpEvidence, [], ["PresentOutcomes"], ["ConversationSpeakers"], ["Evidence.json", "EvidenceTranscript.html"]),
+    DumpStage(dumpInteractables, ["Interactable"], [], ["ConversationSpeakers"], ["Interactables.json", "InteractablesTranscript.html"]),
+    DumpStage(dumpAnimOutcomes, ["OutcomeOnStateEnter"], [], ["ConversationSpeakers"], ["OutcomesOnEnter.json", "OutcomesOnEnterTranscript.html"]),
+]
+FINAL_STAGE = DumpStage(dumpOutcomes, ["OutcomeCanvas"], [], ["ConversationSpeakers", "outcomes_seen", "references"], ["Outcomes.json", "OutcomesTranscript.html"])
+
+def referencesSignature(hashes):
+    try:
+        stat = os.stat(references.cache_path)
+    except FileNotFoundError:
+        return None
+    return (stat.st_size, stat.st_mtime_ns)
+
+def conversationSpeakersSignature(hashes):
+    # Built in main() before any stage runs, so its class is never traced
+    records = [(k, hashes.get(k)) for k in archives.keys(utype="ConversationSpeaker")]
+    return (records, hashlib.sha1(moduleSources()["HSConversationSpeaker"].encode("utf-8")).hexdigest())
+
+STAGE_STATE = {
+    "ConversationSpeakers": conversationSpeakersSignature,
+    "outcomes_seen": lambda hashes: sorted(outcomes_seen),
+    "references": referencesSignature,
+}
+
+@lru_cache(None)
+def moduleSources():
+    # Source of each HSMonoBehaviour subclass and dump function in this
+    # module, by name; everything else is shared by all stages, under None
+    with open(__file__, encoding="utf-8") as fp:
+        lines = fp.read().splitlines()
+
+    stage_names = {stage.run.__name__ for stage in DUMP_STAGES + [FINAL_STAGE]}
+    sources = collections.defaultdict(str)
+    # Back to front, so removing a node keeps earlier line numbers valid
+    for node in reversed(ast.parse("\n".join(lines)).body):
+        name = getattr(node, "name", None)
+        obj = globals().get(name)
+        is_hs_class = isinstance(obj, type) and issubclass(obj, HSMonoBehaviour) and obj is not HSMonoBehaviour
+        if not (is_hs_class or name in stage_names):
+            continue
+        start = min([node.lineno] + [d.lineno for d in node.decorator_list]) - 1
+        sources[name] = "\n".join(lines[start:node.end_lineno]) + sources[name]
+        del lines[start:node.end_lineno]
+
+    # Shared code (file index, reference graph...) goes into every stage
+    with open(HiveswapCommon.__file__, encoding="utf-8") as fp:
+        lines += fp.read().splitlines()
+    sources[None] = "\n".join(lines)
+    return sources
+
+def stageState(stage, hashes):
+    return [(name, STAGE_STATE[name](hashes)) for name in stage.state]
+
+def stageFingerprint(stage, trace, state, hashes):
+    sources = moduleSources()
+    classes = {
+        base.__name__
+        for name in trace.classes
+        for base in globals()[name].__mro__
+        if issubclass(base, HSMonoBehaviour) and base is not HSMonoBehaviour
+    }
+    keys = set(trace.records)
+    for utype in stage.types:
+        keys.update(archives.keys(utype=utype))
+    for marker in stage.markers:
+        keys.update(archives.keys(marker=marker))
+
+    h = hashlib.sha1()
+    for name in [None, stage.run.__name__, *sorted(classes)]:
+        h.update(f"{name}\0{sources[name]}\0".encode("utf-8"))
+    for key in sorted(keys):
+        h.update(f"{key}\0{hashes.get(key)}\0".encode("utf-8"))
+    # Exported files can be renamed without any .json record changing
+    for lookup in sorted(trace.files, key=repr):
+        h.update(f"{lookup}\0{file_index.lookup(*lookup)}\0".encode("utf-8"))
+    h.update(repr(state).encode("utf-8"))
+    h.update(JSON_FORMAT.encode("utf-8"))
+    h.update(repr(MERMAID_PRERENDER).encode("utf-8"))
+    h.update(repr(TRANSCRIPT_SHARDS).encode("utf-8"))
+    h.update(repr(SEARCH_INDEX).encode("utf-8"))
+    return h.hexdigest()
+
+def mergeExamples(examples):
+    # Same rule as HSMonoBehaviour.__init__: keep the first useful example
+    for category_name, fields in examples.items():
+        merged = EXAMPLES.setdefault(category_name, {})
+        for k, v in fields.items():
+            old_example = merged.get(k, [])
+            if old_example in [[], None, False] or (isinstance(old_example, dict) and old_example.get("_KeyError")):
+                merged[k] = v
+
+def runDumpStage(stage):
+    # Run one stage with its own outcomes_seen, EXAMPLES and trace,
+    # and return what it added (in a worker or in this process)
+    global outcomes_seen, EXAMPLES, stage_trace, search_entries
+    parent_seen, parent_examples, parent_entries = outcomes_seen, EXAMPLES, search_entries
+
+    outcomes_seen, EXAMPLES, search_entries = set(parent_seen), {}, set()
+    stage_trace = StageTrace(set(), set(), set(), set())
+    # Instances and fragments kept from an earlier stage would hide
+    # their references from the trace
+    clearTypedInstances()
+    clearRenderCache()
+    try:
+        stage.run()
+        return outcomes_seen - parent_seen, EXAMPLES, stage_trace, search_entries
+    finally:
+        outcomes_seen, EXAMPLES, search_entries = parent_seen, parent_examples, parent_entries
+        stage_trace = None
+
+def runDumps(workers=None, force=None):
+    # Run the dump stages, skipping those whose code, records and shared
+    # state are unchanged since they last wrote their outputs
+    global MERMAID_PRERENDER
+    if MERMAID_PRERENDER and shutil.which(MERMAID_RENDERER) is None:
+        # Transcripts would link charts that never get rendered
+        print(f"{MERMAID_RENDERER} not found, rendering mermaid charts in the browser instead")
+        MERMAID_PRERENDER = False
+
+    workers = workers or DUMP_WORKERS
+    force = DUMP_FORCE if force is None else force
+    # Fingerprints are kept in the archive store
+    store = archives if isinstance(archives, ArchiveStore) else None
+    hashes = store.recordHashes() if store else {}
+    search_index = SearchIndex(SEARCH_INDEX) if SEARCH_INDEX else None
+    # Stage name -> EXAMPLES it found, run or saved; merged in stage order
+    # at the end so skipping a stage doesn't change which example wins
+    stage_examples = {}
+
+    def upToDate(stage, state):
+        saved = store.stage(stage.run.__name__) if store and not force else None
+        if saved is None:
+            return False
+        fingerprint, trace, seen, examples = saved
+        outputs = [jsonOutputPath(p) for p in stage.outputs] + list(trace.outputs)
+        if not all(os.path.isfile(p) for p in outputs):
+            return False
+        if search_index and not search_index.hasStage(stage.run.__name__):
+            return False
+        if fingerprint != stageFingerprint(stage, trace, state, hashes):
+            return False
+
+        print(f"Skipping {stage.run.__name__}, unchanged")
+        outcomes_seen.update(seen)
+        stage_examples[stage.run.__name__] = examples
+        return True
+
+    def finish(stage, state, result):
+        seen, examples, trace, entries = result
+        outcomes_seen.update(seen)
+        stage_examples[stage.run.__name__] = examples
+        if search_index:
+            search_index.putStage(stage.run.__name__, entries)
+        if store:
+            store.putStage(stage.run.__name__, stageFingerprint(stage, trace, state, hashes), trace, seen, examples)
+
+    pending = []
+    for stage in DUMP_STAGES:
+        state = stageState(stage, hashes) if store else None
+        if not upToDate(stage, state):
+            pending.append((stage, state))
+
+    if pending and workers > 1 and "fork" in multiprocessing.get_all_start_methods():
+        # Forked workers see the loaded archives without re-reading them
+        context = multiprocessing.get_context("fork")
+        with concurrent.futures.ProcessPoolExecutor(min(workers, len(pending)), mp_context=context) as pool:
+            futures = [pool.submit(runDumpStage, stage) for (stage, state) in pending]
+            for (stage, state), future in zip(pending, futures):
+                finish(stage, state, future.result())
+    else:
+        for (stage, state) in pending:
+            finish(stage, state, runDumpStage(stage))
+
+    state = stageState(FINAL_STAGE, hashes) if store else None
+    if not upToDate(FINAL_STAGE, state):
+        finish(FINAL_STAGE, state, runDumpStage(FINAL_STAGE))
+
+    for stage in DUMP_STAGES + [FINAL_STAGE]:
+        mergeExamples(stage_examples[stage.run.__name__])
+
+    if MERMAID_PRERENDER:
+        mermaid_cache.render()
+
 async def main():
     await loadArchives()
 
@@ -2460,20 +3612,11 @@ async def main():
     # this is literally how the game does it, sorry
     ConversationSpeakers = {
         o.get("SpeakerId"): HSConversationSpeaker(o)
-        for o in iterArchiveFiles()
-        if o.get("_type") == "ConversationSpeaker"
+        for o in iterArchiveFiles(utype="ConversationSpeaker")
     }
 
     try:
-        dumpTriggerVolumes()
-        dumpScenes()
-        dumpItems()
-        dumpAbilities()
-        dumpEvidence()
-        dumpInteractables()
-        dumpTriggerVolumes()
-        dumpAnimOutcomes()
-        dumpOutcomes()
+        runDumps()
     finally:
         pprint.pprint(EXAMPLES, compact=True)
 
@@ -2484,4 +3627,34 @@ async def main():
     # dumpDeep(Outcomes, "Outcomes.yaml")
 
 if __name__ == "__main__":
-    asyncio.run(main())
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--loader", choices=["async", "process"], default=LOADER)
+    parser.add_argument("--workers", type=int, default=LOADER_WORKERS, help="Worker processes for the process loader")
+    parser.add_argument("--dump-workers", type=int, default=DUMP_WORKERS, help="Worker processes for the dump stages, 1 to run them in order")
+    parser.add_argument("--force", action="store_true", help="Re-run dump stages even if their inputs are unchanged")
+    parser.add_argument("--json-format", choices=["indent", "compact", "lines"], default=JSON_FORMAT, help="Layout of the .json dumps; lines writes .jsonl")
+    parser.add_argument("--prerender-mermaid", action="store_true", help=f"Render mermaid charts to SVG in {MERMAID_DIR}/ with {MERMAID_RENDERER} instead of in the browser")
+    parser.add_argument("--shard-transcripts", metavar="scene|N", type=lambda v: v if v == "scene" else int(v), help="Split transcripts per scene or per N items, with an index page")
+    parser.add_argument("--search-index", metavar="PATH", default=SEARCH_INDEX, help="Full-text index of the transcripts to write, empty for none")
+    parser.add_argument("--lazy", action="store_true", help="Resolve typed fields on first use")
+    parser.add_argument("--bench", choices=["loaders", "findrefs", "canvas"], help="Run a benchmark instead of dumping")
+    args = parser.parse_args()
+
+    LOADER = args.loader
+    LOADER_WORKERS = args.workers
+    DUMP_WORKERS = args.dump_workers
+    DUMP_FORCE = args.force
+    JSON_FORMAT = args.json_format
+    MERMAID_PRERENDER = args.prerender_mermaid
+    TRANSCRIPT_SHARDS = args.shard_transcripts
+    SEARCH_INDEX = args.search_index or None
+    HSMonoBehaviour.LAZY = args.lazy
+
+    if args.bench == "loaders":
+        asyncio.run(benchmarkLoaders())
+    elif args.bench == "findrefs":
+        benchmarkFindRefs()
+    elif args.bench == "canvas":
+        benchmarkCanvas()
+    else:
+        asyncio.run(main())
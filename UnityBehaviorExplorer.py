@@ -1,26 +1,17 @@
-from flask import Flask
+from flask import Flask, abort, request, send_from_directory
 import glob
 import os
 import json
-from collections import namedtuple
-import collections
 import re
-from functools import lru_cache
 import textwrap
 import logging
-import pickle
 import base64
 import itertools
+import time
+import argparse
+import html
 
-try:
-    from tqdm import tqdm
-except ImportError:
-    print("tqdm not installed, using dumb iterator")
-
-    def tqdm(iterable, *args):
-        yield from iterable
-
-FileID = namedtuple("FileID", ["fileName", "pathId"])
+from HiveswapCommon import FileID, FileIndex, MermaidCache, ReferenceGraph, SearchIndex, jsonLoad
 
 def safe(x):
     return x.replace('#', '$')
@@ -30,58 +21,34 @@ game_root = "."
 
 file_paths = sorted(glob.glob(game_root + "/*/MonoBehaviour/*"))
 
-def findRefs(x, name=""):
-    if isinstance(x, dict):
-        if 'm_FileName' in x:
-            id_ = FileID(x['m_FileName'], str(x['m_PathID']))
-            yield (id_, name)
-        for k, v in x.items():
-            yield from findRefs(v, name=name + "." + k)
-    elif isinstance(x, list):
-        for v in x:
-            yield from findRefs(v, name=name)
-
-def ddictlist():
-    # module level function, picklable
-    return collections.defaultdict(list)
-
-
-referencesFrom = collections.defaultdict(list)
-referencedBy = collections.defaultdict(list)
-referencedAs = collections.defaultdict(ddictlist)
-
-reference_cache_filepath = "refs.pickle"
-try:
-    with open(reference_cache_filepath, "rb") as fp:
-        (referencesFrom, referencedBy, referencedAs) = pickle.load(fp)
-    print("Loaded cached references")
-except (FileNotFoundError, EOFError):
-    print("Building references...")
-    for path in tqdm(file_paths):
-        (folder_name, path_id) = re.match(r"(.*?)\/.*\#(\d+)\.json", path.replace("\\", "/")).groups()
-        source = FileID(folder_name, path_id)
-        with open(os.path.join(path), 'r', encoding="utf-8") as fp:
-            parsed = json.load(fp)
-
-        # todo make this faster
-        for target, refd_as in findRefs(parsed):
-            if target.fileName is not None:
-                referencesFrom[source].append(target)
-                referencedBy[target].append(source)
-                referencedAs[target][source].append(refd_as)
-
-    with open(reference_cache_filepath, "wb") as fp:
-        tup = (referencesFrom, referencedBy, referencedAs,)
-        pickle.dump(tup, fp)
+references = ReferenceGraph("refs.refgraph", game_root, compact=True)
+file_index = FileIndex("files.pickle", game_root)
+# Reference graphs prerendered with --prerender-mermaid
+mermaid_cache = MermaidCache("mermaid")
+# Transcripts and their full-text index, as written by HiveswapScript2.
+# It writes them to its working directory, two levels above its
+# game_root (Act2-AssetStudio/ExportDev2), which is where this runs
+transcript_root = os.path.join("..", "..")
+search_path = os.path.join(transcript_root, "search.sqlite")
+search_index = None
+
+def searchIndex():
+    # Opened on first use rather than at import, so a server started
+    # before the first dump finds the index once it is written
+    global search_index
+    if search_index is None and os.path.isfile(search_path):
+        search_index = SearchIndex(search_path)
+    return search_index
 
 def getReferencesHtml(file_id):
-    if file_id not in referencedBy:
+    if file_id not in references.referencedBy:
         return '<p>No references to this file</p>'
 
-    return "<p>Referenced by:</p><ul>" + "\n".join(["<li>" + fileIdToLink(ref) + " as " + ", ".join(referencedAs[file_id][ref]) + "</li>" for ref in set(referencedBy[file_id])]) + "</ul>"
+    names = references.referencedAs[file_id]
+    return "<p>Referenced by:</p><ul>" + "\n".join(["<li>" + fileIdToLink(ref) + " as " + ", ".join(names[ref]) + "</li>" for ref in set(references.referencedBy[file_id])]) + "</ul>"
 
-@lru_cache(10000)
 def fileIdToName(ref):
+    targetNames = None
     try:
         assert ref.fileName is not None
         if ref.fileName == ".":
@@ -89,15 +56,13 @@ def fileIdToName(ref):
             archive = "*"
         else:
             archive = ref.fileName
-        target_glob = os.path.join(archive, "*", f"*#{ref.pathId}.*")
-        targetNames = glob.glob(target_glob)
+        targetNames = file_index.lookup(archive, ref.pathId)
 
         assert len(targetNames) == 1
-        targetName = targetNames[0].replace('\\', '/')
+        targetName = targetNames[0]
         return targetName
     except (AssertionError, IndexError):
         logging.warning(ref)
-        logging.warning(target_glob)
         logging.warning(targetNames)
         return f"Unknown! ({ref.fileName}/{ref.pathId})"
 
@@ -116,79 +81,152 @@ def graphFileRefs(root, max_dist=1):
     def fikey(file_id):
         return f"{str(file_id.fileName)}.{file_id.pathId}".replace(' ', '_').replace(')', '').replace('(', '')  
 
-    def _graphFileRefs(root, visited=None, mermaid_defined=None, recursive=1):
-        if visited is None:
-            visited = list()
-        if mermaid_defined is None:
-            mermaid_defined = list()
-
+    def _fileRefKeys(root):
         keys = []
-        # print(root, recursive)
 
         if root.fileName is None:
-            return
+            return keys
 
-        for source in referencedBy[root]:
-            for refd_as in referencedAs[root][source]:
+        names = references.referencedAs[root]
+        for source in references.referencedBy[root]:
+            for refd_as in names[source]:
                 # Root is referenced by name refd_as by source
-                key = (root, refd_as, source)
-                keys.append(key)
+                keys.append((root, refd_as, source))
 
-        for target in referencesFrom[root]:
-            for refd_as in referencedAs[target][root]:
+        for target in references.referencesFrom[root]:
+            for refd_as in references.referencedAs[target][root]:
                 # Target is referenced by name refd_as by root
-                key = (target, refd_as, root)
-                keys.append(key)
+                keys.append((target, refd_as, root))
+
+        return keys
 
-        # print(keys)
+    def _graphFileRefs(root, recursive=1):
+        # Depth first over reference edges, source side before target side.
+        # Each frame is [root, edges left, recursive]
+        visited = set()
+        mermaid_defined = set()
+        stack = [[root, iter(_fileRefKeys(root)), recursive]]
 
-        for key in keys:
-            (target, refd_as, source) = key
+        while stack:
+            frame = stack[-1]
+            (root, keys, recursive) = frame
 
-            if key in visited:
-                continue
+            for key in keys:
+                (target, refd_as, source) = key
 
-            if refd_as in [".nodeKnobs"]:
-                recursive += 1
+                if key in visited:
+                    continue
 
-            # print(key)
+                if refd_as in [".nodeKnobs"]:
+                    recursive += 1
+                    frame[2] = recursive
 
-            visited.append(key)
+                visited.add(key)
 
-            for node in [source, target]:
-                key = fikey(node)
-                if key not in mermaid_defined:
-                    po, pc = ("[", "]")
+                for node in [source, target]:
+                    key = fikey(node)
+                    if key not in mermaid_defined:
+                        po, pc = ("[", "]")
 
-                    # Mark root node w/ stadium
-                    if len(visited) == 1 and node is root:
-                        po, pc = ("([", "])")
+                        # Mark root node w/ stadium
+                        if len(visited) == 1 and node is root:
+                            po, pc = ("([", "])")
 
-                    yield f"  {key}{po}{fileIdToName(node).replace(' ','_').replace(')', '').replace('(', '').replace('MonoBehaviour/', '')}{pc}"
-                    yield f"  click {key} \"{safe(f'/file/{fileIdToName(node)}')}\""
+                        yield f"  {key}{po}{fileIdToName(node).replace(' ','_').replace(')', '').replace('(', '').replace('MonoBehaviour/', '')}{pc}"
+                        yield f"  click {key} \"{safe(f'/file/{fileIdToName(node)}')}\""
 
-                    if not (recursive > 0):
-                        yield f"  style {key} fill:#fff0"
+                        if not (recursive > 0):
+                            yield f"  style {key} fill:#fff0"
 
-                    mermaid_defined.append(key)
+                        mermaid_defined.add(key)
 
-            to_str = f"{fikey(target)}"
-            from_str = f"{fikey(source)}"
-            yield f"  {from_str}-->|{refd_as}| {to_str}"
+                to_str = f"{fikey(target)}"
+                from_str = f"{fikey(source)}"
+                yield f"  {from_str}-->|{refd_as}| {to_str}"
 
-            if recursive > 0:
-                yield from _graphFileRefs(source, visited, mermaid_defined, recursive=recursive-1)
-                yield from _graphFileRefs(target, visited, mermaid_defined, recursive=recursive-1)
+                if recursive > 0:
+                    # Target is pushed first so source is walked first
+                    stack.append([target, iter(_fileRefKeys(target)), recursive - 1])
+                    stack.append([source, iter(_fileRefKeys(source)), recursive - 1])
+                    break
+            else:
+                stack.pop()
 
-    ret = "graph LR\n" + "\n".join(list(_graphFileRefs(root)))
+    ret = "graph LR\n" + "\n".join(_graphFileRefs(root))
     return ret
 
+def fileIdFromPath(path):
+    (archive, path_id) = re.match(r".*[\\/](.*)[\\/]MonoBehaviour[\\/].* \#(\d+)\.json", path).groups()
+    return FileID(archive, path_id)
+
+def graphFileRefsHtml(file_id):
+    graph = graphFileRefs(file_id)
+    key = mermaid_cache.key(graph)
+    if os.path.isfile(mermaid_cache.svgPath(key)):
+        # <object>, not <img>, so the click links in the chart still work
+        return f"<object class='mermaid' type='image/svg+xml' data='/mermaid/{key}.svg'></object>"
+    return '<script src="https://cdn.jsdelivr.net/npm/mermaid/dist/mermaid.min.js"></script><script>mermaid.initialize({startOnLoad:true});</script>' + f'''        
+        <div class='mermaid' style="overflow: auto;">{graph}</div>'''
+
+def prerenderFileRefs():
+    # Render the reference graph of every file ahead of time, so pages
+    # don't need mermaid.js
+    for path in file_paths:
+        mermaid_cache.add(graphFileRefs(fileIdFromPath(path)))
+    mermaid_cache.render()
+
+def searchResultsHtml(query, kind=None):
+    index = searchIndex()
+    if index is None:
+        return f'<p>No search index, run HiveswapScript2 to write {search_path}</p>'
+
+    start = time.perf_counter()
+    hits = index.search(query, kind=kind)
+    elapsed = time.perf_counter() - start
+
+    rows = []
+    for hit in hits:
+        asset = fileIdToLink(FileID(hit.folder_name, hit.path_id)) if hit.path_id is not None else ""
+        rows.append(
+            f"<li>{hit.snippet} <i>({hit.kind})</i>"
+            f" <a href='/transcripts/{hit.page}#{hit.anchor}'>{hit.page}#{hit.anchor}</a> {asset}</li>"
+        )
+    return f"<p>{len(hits)} results in {elapsed * 1000:.1f} ms</p><ul>" + "\n".join(rows) + "</ul>"
+
+def benchmarkGraphFileRefs(top=20):
+    # Time graphFileRefs on the most referenced assets
+    file_ids = []
+    for path in file_paths:
+        file_id = fileIdFromPath(path)
+        if file_id in references.referencedBy:
+            file_ids.append(file_id)
+
+    most_referenced = sorted(file_ids, key=lambda file_id: len(references.referencedBy[file_id]), reverse=True)[:top]
+    for file_id in most_referenced:
+        start = time.perf_counter()
+        graph = graphFileRefs(file_id)
+        elapsed = time.perf_counter() - start
+        print(f"{len(references.referencedBy[file_id]):>6} referrers, {graph.count('-->'):>6} edges: {elapsed:.3f}s {file_id}")
+
 
 # graphFileRefs("sharedassets25.assets", "1607")
 
 b64 = None
 
 if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--bench", action="store_true", help="Time reference graphs of the most referenced assets instead of serving")
+    parser.add_argument("--prerender-mermaid", action="store_true", help="Render every reference graph to SVG before serving")
+    parser.add_argument("--transcripts", metavar="DIR", default=transcript_root, help="Directory HiveswapScript2 wrote its transcripts and search index to")
+    args = parser.parse_args()
+    transcript_root = args.transcripts
+    search_path = os.path.join(transcript_root, "search.sqlite")
+    if args.bench:
+        benchmarkGraphFileRefs()
+        raise SystemExit
+    if args.prerender_mermaid:
+        prerenderFileRefs()
+
     app = Flask(__name__)
 
     @app.route('/')
@@ -204,8 +242,8 @@ if __name__ == "__main__":
         filename = filename.replace('$', '#') + ".json"
         print(filename)
         (path_id,) = re.match(r".* \#(\d+)\.json", filename).groups()
-        with open(os.path.join(archive, 'MonoBehaviour', filename), encoding="utf-8") as f:
-            parsed = json.load(f)
+        with open(os.path.join(archive, 'MonoBehaviour', filename), 'rb') as f:
+            parsed = jsonLoad(f)
 
         fileId = FileID(archive, path_id)
         references = getReferencesHtml(fileId)
@@ -245,11 +283,34 @@ if __name__ == "__main__":
         print("traversed")
         ret = f'''<h1>{fileIdToLink(fileId)}</h1>
         {references}
-        <pre style="overflow-wrap: anywhere;white-space: pre-wrap;">{json.dumps(parsed, indent=4, sort_keys=False)}</pre>''' + '<script src="https://cdn.jsdelivr.net/npm/mermaid/dist/mermaid.min.js"></script><script>mermaid.initialize({startOnLoad:true});</script>' + f'''        
-        <div class='mermaid' style="overflow: auto;">{graphFileRefs(fileId)}</div>'''
+        <pre style="overflow-wrap: anywhere;white-space: pre-wrap;">{json.dumps(parsed, indent=4, sort_keys=False)}</pre>''' + graphFileRefsHtml(fileId)
         print("done")
         return f'<html><head></head><body>{ret}</body></html>'
 
+    @app.route('/search')
+    def search():
+        query = request.args.get("q", "")
+        kind = request.args.get("kind") or None
+        ret = f'''<form action="/search"><input name="q" value="{html.escape(query)}"> <input type="submit" value="Search"></form>'''
+        if query:
+            ret += searchResultsHtml(query, kind)
+        return f'<html><head></head><body>{ret}</body></html>', 200, {'Content-Type': 'text/html; charset=utf-8'}
+
+    @app.route('/transcripts/<page>')
+    def transcript(page):
+        if not page.endswith((".html", ".css")):
+            abort(404)
+        return send_from_directory(os.path.abspath(transcript_root), page)
+
+    @app.route('/transcripts/mermaid/<key>.svg')
+    def transcriptMermaid(key):
+        # Charts of transcripts written with --prerender-mermaid
+        return send_from_directory(os.path.abspath(os.path.join(transcript_root, "mermaid")), key + ".svg")
+
+    @app.route('/mermaid/<key>.svg')
+    def mermaid(key):
+        return send_from_directory(os.path.abspath(mermaid_cache.root), key + ".svg")
+
     @app.route('/file/<archive>/<type>/<subtype> $<path_id>.dat')
     def showdat(archive, type, subtype, path_id):
         with open(os.path.join(archive, type, f"{subtype} #{path_id}.dat"), 'rb') as f: